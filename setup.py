@@ -24,7 +24,8 @@ setup(
     install_requires=['django'],
     extras_require = {
         'xlsx': ["openpyxl"],
-        'ods': ["odfpy"],
+        'ods': [],
         'xls': ["xlrd"],
+        'numpy': ["numpy"],
     },
 )
@@ -0,0 +1,398 @@
+""" On disk cache of parsed import files
+The first complete read of an import file writes its parsed rows (blank
+header columns already projected out) to a spool file. Later reads, like the
+commit run after a dry run, read the spool instead of running xlrd,
+openpyxl or the ods parser again.
+
+A spool is columnar. Rows are stored in groups of ROWS_PER_GROUP, and each
+column of a group is typed: int and float columns are packed 8 byte values,
+text is one utf-8 block plus offsets, anything else (dates, mixed types) is
+JSON with tagged dates, times and decimals. Spools are never unpickled, so a
+planted spool can't run code. A footer indexes where every column of every
+group starts, so a memory-mapped Spool can read any row or range of rows
+without decoding the rest of the file. Parallel imports hand workers row
+ranges of the spool rather than the rows themselves.
+
+Spools are stored next to the import file, named after a hash of its
+content, when the storage has local paths. Otherwise or when
+SIMPLE_IMPORT_CACHE_DIR is set they go there, by default a simple_import
+directory in the system temp dir that only we may use. When the spools in a
+directory grow past SIMPLE_IMPORT_CACHE_SIZE bytes the least recently used
+ones are deleted. Set either to 0 or '' to turn caching off.
+"""
+import datetime
+import decimal
+import hashlib
+import json
+import logging
+import mmap
+import os
+import stat
+import struct
+import tempfile
+
+from django.conf import settings
+
+from .utils import chunked
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'simple_import spool 2\n'
+ROWS_PER_GROUP = 1000
+SPOOL_SUFFIX = '.spool'
+FOOTER_OFFSET = struct.Struct('<Q')
+
+INTEGER = 'q'
+FLOAT = 'd'
+TEXT = 's'
+OBJECT = 'o'
+
+INT64_MIN = -2 ** 63
+INT64_MAX = 2 ** 63 - 1
+
+
+def get_cache_dir():
+    cache_dir = getattr(settings, 'SIMPLE_IMPORT_CACHE_DIR', None)
+    if cache_dir is None:
+        cache_dir = os.path.join(tempfile.gettempdir(), 'simple_import')
+    return cache_dir
+
+
+def make_private_dir(path):
+    """ Create path readable and writable only by us, or check that an
+    existing one is. Anyone can create a directory in the shared temp dir
+    first and read or plant spools in it. """
+    try:
+        os.makedirs(path, mode=0o700, exist_ok=True)
+        path_stat = os.lstat(path)
+        if not hasattr(os, 'geteuid'):
+            # Windows, temp dirs are per user
+            return True
+        if not stat.S_ISDIR(path_stat.st_mode) or path_stat.st_uid != os.geteuid():
+            logger.warning("Not caching imports in %s, it isn't our own directory", path)
+            return False
+        if path_stat.st_mode & 0o077:
+            os.chmod(path, 0o700)
+    except OSError:
+        logger.warning("Could not create import cache directory %s", path, exc_info=True)
+        return False
+    return True
+
+
+def get_cache_size():
+    return getattr(settings, 'SIMPLE_IMPORT_CACHE_SIZE', 256 * 1024 * 1024)
+
+
+def get_file_hash(import_file):
+    digest = hashlib.sha1()
+    import_file.seek(0)
+    for data in import_file.chunks():
+        digest.update(data)
+    import_file.seek(0)
+    return digest.hexdigest()
+
+
+def get_local_path(import_file):
+    try:
+        return import_file.path
+    except (AttributeError, NotImplementedError, ValueError):
+        # Remote storage, no file at all or not a stored file
+        return None
+
+
+def get_spool_path(import_log):
+    """ Where the parsed rows of import_log's file are cached, or None when
+    caching is off """
+    cache_dir = get_cache_dir()
+    if not cache_dir or not get_cache_size() or import_log.pk is None:
+        return None
+    if getattr(settings, 'SIMPLE_IMPORT_CACHE_DIR', None) is None:
+        file_path = get_local_path(import_log.import_file)
+        if file_path:
+            return '{0}.{1}{2}'.format(
+                file_path, import_log.get_file_hash(), SPOOL_SUFFIX)
+        if not make_private_dir(cache_dir):
+            return None
+    return os.path.join(cache_dir, '{0}-{1}{2}'.format(
+        import_log.pk, import_log.get_file_hash(), SPOOL_SUFFIX))
+
+
+def encode_object(value):
+    """ JSON for the cell types readers return that JSON doesn't have.
+    Cells are never dicts themselves, so a one item dict is a tag. """
+    if isinstance(value, datetime.datetime):
+        return {'datetime': value.isoformat()}
+    if isinstance(value, datetime.date):
+        return {'date': value.isoformat()}
+    if isinstance(value, datetime.time):
+        return {'time': value.isoformat()}
+    if isinstance(value, datetime.timedelta):
+        return {'timedelta': [value.days, value.seconds, value.microseconds]}
+    if isinstance(value, decimal.Decimal):
+        return {'decimal': str(value)}
+    raise TypeError("Can't cache a cell of type %s" % type(value).__name__)
+
+
+def decode_object(tagged):
+    if len(tagged) == 1:
+        (tag, value), = tagged.items()
+        if tag == 'datetime':
+            return datetime.datetime.fromisoformat(value)
+        if tag == 'date':
+            return datetime.date.fromisoformat(value)
+        if tag == 'time':
+            return datetime.time.fromisoformat(value)
+        if tag == 'timedelta':
+            return datetime.timedelta(*value)
+        if tag == 'decimal':
+            return decimal.Decimal(value)
+    return tagged
+
+
+def encode_json(data):
+    return json.dumps(data, default=encode_object, separators=(',', ':')).encode('utf-8')
+
+
+def decode_json(data):
+    return json.loads(bytes(data).decode('utf-8'), object_hook=decode_object)
+
+
+def column_kind(values):
+    kind = None
+    for value in values:
+        if value is None:
+            continue
+        value_type = type(value)
+        if value_type is int and INT64_MIN <= value <= INT64_MAX:
+            value_kind = INTEGER
+        elif value_type is float:
+            value_kind = FLOAT
+        elif value_type is str:
+            value_kind = TEXT
+        else:
+            return OBJECT
+        if kind is None:
+            kind = value_kind
+        elif kind != value_kind:
+            return OBJECT
+    return kind or TEXT
+
+
+class SpoolWriter(object):
+    """ Write rows to a spool file, one group of rows at a time """
+    def __init__(self, spool):
+        self.spool = spool
+        self.groups = []
+        self.offset = 0
+        self.write(MAGIC)
+
+    def write(self, data):
+        self.spool.write(data)
+        self.offset += len(data)
+        return self.offset - len(data)
+
+    def write_group(self, rows):
+        """ rows must hold ROWS_PER_GROUP rows, except for the last group,
+        so row n can be found in group n // ROWS_PER_GROUP """
+        columns = [self.write_column(column) for column in zip(*rows)]
+        self.groups += [(len(rows), columns)]
+
+    def write_column(self, values):
+        """ Returns (kind, null mask offset, data offset, data length, text
+        index offset) for the footer """
+        count = len(values)
+        kind = column_kind(values)
+        nulls = -1
+        if kind != OBJECT and None in values:
+            nulls = self.write(bytes(value is None for value in values))
+        index = -1
+        if kind == INTEGER or kind == FLOAT:
+            data = struct.pack(
+                '<%d%s' % (count, kind),
+                *(0 if value is None else value for value in values))
+        elif kind == TEXT:
+            # Offsets count characters, so the whole block is decoded in one go
+            offsets = [0]
+            for value in values:
+                offsets += [offsets[-1] + (len(value) if value is not None else 0)]
+            index = self.write(struct.pack('<%dq' % (count + 1), *offsets))
+            data = ''.join(value for value in values if value is not None).encode('utf-8')
+        else:
+            data = encode_json(list(values))
+        return (kind, nulls, self.write(data), len(data), index)
+
+    def close(self):
+        footer = encode_json({
+            'rows_per_group': ROWS_PER_GROUP,
+            'groups': self.groups,
+        })
+        footer_offset = self.write(footer)
+        self.write(FOOTER_OFFSET.pack(footer_offset))
+        self.spool.close()
+
+
+class Spool(object):
+    """ A memory-mapped spool. Reading a row decodes only its own group. """
+    def __init__(self, path):
+        with open(path, 'rb') as spool:
+            self.mmap = mmap.mmap(spool.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            if self.mmap[:len(MAGIC)] != MAGIC:
+                raise ValueError("{0} is not a spool".format(path))
+            footer_offset, = FOOTER_OFFSET.unpack_from(
+                self.mmap, len(self.mmap) - FOOTER_OFFSET.size)
+            footer = decode_json(self.mmap[footer_offset:-FOOTER_OFFSET.size])
+        except Exception:
+            self.mmap.close()
+            raise
+        self.rows_per_group = footer['rows_per_group']
+        self.groups = footer['groups']
+        self.row_count = sum(count for count, columns in self.groups)
+
+    def __len__(self):
+        return self.row_count
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.mmap.close()
+
+    def read_column(self, count, column):
+        kind, nulls, offset, length, index = column
+        buf = self.mmap
+        if kind == INTEGER or kind == FLOAT:
+            values = list(struct.unpack_from('<%d%s' % (count, kind), buf, offset))
+        elif kind == TEXT:
+            offsets = struct.unpack_from('<%dq' % (count + 1), buf, index)
+            text = buf[offset:offset + length].decode('utf-8')
+            values = [text[offsets[i]:offsets[i + 1]] for i in range(count)]
+        else:
+            return decode_json(buf[offset:offset + length])
+        if nulls != -1:
+            for i, is_null in enumerate(buf[nulls:nulls + count]):
+                if is_null:
+                    values[i] = None
+        return values
+
+    def read_group(self, group_index):
+        count, columns = self.groups[group_index]
+        if not columns:
+            return [[] for i in range(count)]
+        return [list(row) for row in zip(*(
+            self.read_column(count, column) for column in columns))]
+
+    def row(self, row_index):
+        if not 0 <= row_index < self.row_count:
+            raise IndexError("spool row index out of range")
+        group_index, offset = divmod(row_index, self.rows_per_group)
+        return self.read_group(group_index)[offset]
+
+    def iter_rows(self, start=0, stop=None):
+        """ Yield rows start up to stop, decoding one group at a time """
+        if stop is None or stop > self.row_count:
+            stop = self.row_count
+        while start < stop:
+            group_index, offset = divmod(start, self.rows_per_group)
+            rows = self.read_group(group_index)
+            end = min(len(rows), offset + stop - start)
+            yield from rows[offset:end]
+            start += end - offset
+
+    def __iter__(self):
+        return self.iter_rows()
+
+
+def remove_spool(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def read_spool(path, start=0, stop=None):
+    """ Yield the rows of the spool at path """
+    spool = Spool(path)
+    try:
+        # Mark it as recently used for eviction
+        os.utime(path)
+        yield from spool.iter_rows(start, stop)
+    finally:
+        spool.close()
+
+
+def write_through(rows, path):
+    """ Yield rows while copying them into a spool at path. The spool is
+    only kept if rows is read to the end, an import stopped early or a
+    preview of a few rows leaves nothing behind. A spool that grows past
+    SIMPLE_IMPORT_CACHE_SIZE is dropped as soon as it does, it would only
+    be evicted once written. """
+    writer = None
+    temp_path = None
+    max_size = get_cache_size()
+
+    def discard():
+        nonlocal writer, temp_path
+        if writer is not None:
+            writer.spool.close()
+            writer = None
+        if temp_path is not None and os.path.exists(temp_path):
+            os.remove(temp_path)
+        temp_path = None
+
+    try:
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, temp_path = tempfile.mkstemp(
+                dir=os.path.dirname(path), suffix=SPOOL_SUFFIX + '.tmp')
+            writer = SpoolWriter(os.fdopen(fd, 'wb'))
+        except OSError:
+            logger.warning("Could not create import cache in %s", path, exc_info=True)
+
+        for chunk in chunked(rows, ROWS_PER_GROUP):
+            if writer is not None:
+                try:
+                    writer.write_group(chunk)
+                except (OSError, TypeError, ValueError):
+                    logger.warning("Could not write import cache %s", path, exc_info=True)
+                    discard()
+                else:
+                    if writer.offset > max_size:
+                        logger.info(
+                            "Not caching %s, it's bigger than SIMPLE_IMPORT_CACHE_SIZE", path)
+                        discard()
+            yield from chunk
+
+        if writer is not None:
+            writer.close()
+            writer = None
+            os.replace(temp_path, path)
+            temp_path = None
+            evict(os.path.dirname(path), max_size)
+    finally:
+        discard()
+
+
+def evict(cache_dir, max_size):
+    """ Delete the least recently used spools until the rest fit in
+    max_size bytes """
+    spools = []
+    for entry in os.scandir(cache_dir):
+        if entry.name.endswith(SPOOL_SUFFIX):
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            spools += [(stat.st_mtime, stat.st_size, entry.path)]
+    total = sum(size for mtime, size, path in spools)
+    for mtime, size, path in sorted(spools):
+        if total <= max_size:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
@@ -0,0 +1,1159 @@
+""" The import engine behind the do_import view
+Rows are either saved one at a time, exactly like a user editing each record,
+or written in batches with bulk_create/bulk_update when the model allows it.
+"""
+from collections import OrderedDict
+import csv
+import io
+from itertools import islice
+from operator import attrgetter
+import pickle
+import tempfile
+import time
+
+import django
+from django.conf import settings
+from django.contrib.admin.models import LogEntry, ADDITION, CHANGE
+from django.contrib.contenttypes.models import ContentType
+from django.core.exceptions import ObjectDoesNotExist, ValidationError
+from django.contrib.auth import get_user_model
+from django.db import connection, connections, models, transaction, IntegrityError
+from django.db.models import ForeignKey
+from django.db.models.fields import BooleanField
+from django.db.models.signals import m2m_changed, pre_save, post_save
+from django.utils.encoding import smart_text
+
+from .models import ColumnMatch, ImportedBlock, ImportedObject, ImportLog, RelationalMatch
+from .parsing import BOOLEAN_STRINGS, ColumnParser, ParseError, get_parse_type, parse_chunk
+from .utils import chunked
+
+SUPPORTS_IGNORE_CONFLICTS = django.VERSION >= (2, 2)
+
+# Primary keys that fit in ImportedObject.object_id
+IMPORTED_OBJECT_KEY_TYPES = {
+    'AutoField', 'IntegerField', 'PositiveIntegerField',
+    'PositiveSmallIntegerField', 'SmallAutoField', 'SmallIntegerField',
+}
+NOT_A_CHOICE = object()
+
+
+class RelatedKeyIndex(object):
+    """ In memory index of related objects by the unique field a column is
+    matched on. Keys for a whole chunk are loaded with one field__in query
+    and reused across rows. The least recently used keys are evicted once
+    the index holds more than max_size objects, a max_size below 1 turns the
+    index off and every key is queried on its own. """
+    MISSING = object()
+    MULTIPLE = object()
+    query_size = 500
+
+    def __init__(self, related_model, field_name, max_size=None):
+        self.related_model = related_model
+        self.field_name = field_name
+        self.field = related_model._meta.get_field(field_name)
+        if max_size is None:
+            max_size = getattr(settings, 'SIMPLE_IMPORT_RELATED_CACHE_SIZE', 100000)
+        self.max_size = max_size
+        self.objects = OrderedDict()
+
+    def normalize(self, cell):
+        # The same conversion the ORM would do for objects.get(field=cell)
+        return self.field.get_prep_value(cell)
+
+    def query(self, cell):
+        """ Look up a single key, compared the way the database compares it """
+        related_objects = list(self.related_model._default_manager.filter(**{
+            self.field_name: cell})[:2])
+        if not related_objects:
+            return self.MISSING
+        if len(related_objects) > 1:
+            return self.MULTIPLE
+        return related_objects[0]
+
+    def load(self, cells):
+        """ Fetch every key in cells that isn't already indexed """
+        if self.max_size < 1:
+            return
+        keys = OrderedDict()
+        for cell in cells:
+            try:
+                key = self.normalize(cell)
+            except Exception:
+                # Left for get() to raise on the row that has it
+                continue
+            if key is not None and key not in self.objects:
+                keys[key] = None
+        keys = list(keys)
+        for start in range(0, len(keys), self.query_size):
+            batch = keys[start:start + self.query_size]
+            found = {}
+            for related_object in self.related_model._default_manager.filter(**{
+                    self.field_name + '__in': batch}):
+                key = self.normalize(getattr(related_object, self.field.attname))
+                found[key] = self.MULTIPLE if key in found else related_object
+            # Objects the database matched to a key that isn't equal in
+            # python, like "ABC" and "abc" under a case insensitive MySQL
+            # collation. Keys without an equal object are looked up alone.
+            unclaimed = set(found).difference(batch)
+            for key in batch:
+                related_object = found.get(key, self.MISSING)
+                if related_object is self.MISSING and unclaimed:
+                    related_object = self.query(key)
+                self.objects[key] = related_object
+        while len(self.objects) > self.max_size:
+            self.objects.popitem(last=False)
+
+    def get(self, cell):
+        if self.max_size < 1:
+            related_object = self.query(cell)
+        else:
+            key = self.normalize(cell)
+            if key not in self.objects:
+                self.load([cell])
+            related_object = self.objects.get(key, self.MISSING)
+            if key in self.objects:
+                self.objects.move_to_end(key)
+        if related_object is self.MISSING:
+            raise self.related_model.DoesNotExist(
+                "%s matching query does not exist." %
+                self.related_model._meta.object_name)
+        if related_object is self.MULTIPLE:
+            raise self.related_model.MultipleObjectsReturned(
+                "get() returned more than one %s" %
+                self.related_model._meta.object_name)
+        return related_object
+
+
+class ImportColumn(object):
+    """ A matched column resolved once per import: the field it sets, what
+    kind of field that is and, for relations, the related model and the
+    unique field the cell is looked up by. """
+    PLAIN = 'plain'
+    CHOICE = 'choice'
+    BOOLEAN = 'boolean'
+    FOREIGN_KEY = 'foreign_key'
+    M2M = 'm2m'
+    METHOD = 'method'
+
+    def __init__(self, model_class, field_name, related_field_name='',
+                 default_value='', null_on_empty=False):
+        self.field_name = field_name
+        self.related_field_name = related_field_name
+        self.default_value = default_value
+        self.null_on_empty = null_on_empty
+        self.field = None
+        self.related_model = None
+        self.key_index = None
+        self.through = None
+
+        if field_name.startswith('simple_import_method__'):
+            self.kind = self.METHOD
+            self.method_name = field_name[22:]
+            return
+        field = model_class._meta.get_field(field_name)
+        self.field = field
+        if field.many_to_many:
+            self.kind = self.M2M
+            self.related_model = field.related_model
+            through = getattr(field.remote_field, 'through', None)
+            if (not field.auto_created and through is not None and
+                    through._meta.auto_created):
+                # Links for a batch can go straight into the through table
+                self.through = through
+        elif isinstance(field, ForeignKey):
+            self.kind = self.FOREIGN_KEY
+            try:
+                self.related_model = field.remote_field.parent_model()
+            except AttributeError:
+                self.related_model = field.remote_field.model
+        elif field.choices and getattr(settings, 'SIMPLE_IMPORT_LAZY_CHOICES', True):
+            self.kind = self.CHOICE
+            self.strip_choices = getattr(settings, 'SIMPLE_IMPORT_LAZY_CHOICES_STRIP', False)
+        elif isinstance(field, BooleanField):
+            self.kind = self.BOOLEAN
+        else:
+            self.kind = self.PLAIN
+
+    def get_related_object(self, cell):
+        if self.key_index is not None:
+            return self.key_index.get(cell)
+        return self.related_model.objects.get(**{self.related_field_name: cell})
+
+    def compile_setter(self):
+        """ Build a function(new_object, cell) that sets this column's field,
+        with everything that doesn't depend on the cell worked out up front.
+        m2m cells are kept on the object to be added after it's saved. """
+        kind = self.kind
+        field_name = self.field_name
+        if kind == self.METHOD:
+            return None
+        elif kind == self.M2M:
+            def set_m2m(new_object, cell):
+                new_object.simple_import_m2ms[field_name] = cell
+            return set_m2m
+        elif kind == self.FOREIGN_KEY:
+            get_related_object = self.get_related_object
+            def set_foreign_key(new_object, cell):
+                setattr(new_object, field_name, get_related_object(cell))
+            return set_foreign_key
+        elif kind == self.CHOICE:
+            strip = self.strip_choices
+            # Prefer database values over choices lookup
+            database_values = set()
+            verbose_values = {}
+            for value, label in self.field.choices:
+                database_values.add(value)
+                verbose_values[smart_text(label)] = value
+            def set_choice(new_object, cell):
+                # Trim leading and trailing whitespace from cell values
+                if strip and isinstance(cell, str):
+                    cell = cell.strip()
+                if cell in database_values:
+                    setattr(new_object, field_name, cell)
+                else:
+                    value = verbose_values.get(smart_text(cell), NOT_A_CHOICE)
+                    if value is not NOT_A_CHOICE:
+                        setattr(new_object, field_name, value)
+            return set_choice
+        elif kind == self.BOOLEAN:
+            def set_boolean(new_object, cell):
+                # Some formats/libraries report booleans as strings
+                if isinstance(cell, str):
+                    cell = BOOLEAN_STRINGS.get(cell.strip().lower(), cell)
+                elif cell == False:
+                    cell = False
+                setattr(new_object, field_name, cell)
+            return set_boolean
+        else:
+            def set_plain(new_object, cell):
+                setattr(new_object, field_name, cell)
+            return set_plain
+
+    def compile_method(self):
+        """ Build a function(new_object, cell) that runs this column's import
+        method, or None for field columns """
+        if self.kind != self.METHOD:
+            return None
+        get_method = attrgetter(self.method_name)
+        def run_method(new_object, cell):
+            get_method(new_object)(cell)
+        return run_method
+
+    def compile(self, is_empty, methods=False):
+        """ The converter the row loop calls for each cell of this column.
+        Blank cells are skipped, cleared (null_on_empty) or replaced by the
+        default value. """
+        convert = self.compile_method() if methods else self.compile_setter()
+        if convert is None or self.null_on_empty:
+            return convert
+        default_value = self.default_value
+        if default_value:
+            def convert_or_default(new_object, cell):
+                convert(new_object, default_value if is_empty(cell) else cell)
+            return convert_or_default
+        def convert_if_not_empty(new_object, cell):
+            if not is_empty(cell):
+                convert(new_object, cell)
+        return convert_if_not_empty
+
+    def set_field(self, new_object, cell):
+        setter = self.compile_setter()
+        if setter is not None:
+            setter(new_object, cell)
+
+    def run_method(self, new_object, cell):
+        method = self.compile_method()
+        if method is not None:
+            method(new_object, cell)
+
+
+def build_import_plan(import_log, model_class, header_row, column_matches=None):
+    """ Resolve every header cell to an ImportColumn, or None when the column
+    isn't used. All the match metadata is read here so the row loop doesn't
+    have to query for it. """
+    related_field_names = dict(
+        import_log.relationalmatch_set.values_list('field_name', 'related_field_name'))
+    if column_matches is None:
+        column_matches = import_log.import_setting.get_column_matches()
+    plan = []
+    for cell in header_row:
+        match = column_matches.find(cell)
+        if match is None or not match.field_name:
+            plan += [None]
+            continue
+        plan += [ImportColumn(
+            model_class,
+            match.field_name,
+            related_field_name=related_field_names.get(match.field_name, ''),
+            default_value=match.default_value,
+            null_on_empty=match.null_on_empty,
+        )]
+    return plan
+
+
+def index_related_keys(plan):
+    """ Give each relational column a RelatedKeyIndex, shared between
+    columns matched to the same related model and field """
+    key_indexes = {}
+    for column in plan:
+        if (column is None or column.related_model is None or
+                not column.related_field_name):
+            continue
+        index_key = (column.related_model, column.related_field_name)
+        if index_key not in key_indexes:
+            key_indexes[index_key] = RelatedKeyIndex(*index_key)
+        column.key_index = key_indexes[index_key]
+
+
+def set_field_from_cell(import_log, new_object, header_row_field_name, cell):
+    """ Set a field from a import cell. Use referenced fields the field
+    is m2m or a foreign key.
+    The Importer resolves an ImportColumn once per column instead of
+    calling this for every cell.
+    """
+    if not header_row_field_name.startswith('simple_import_method__'):
+        column = ImportColumn(type(new_object), header_row_field_name)
+        if column.kind == ImportColumn.FOREIGN_KEY:
+            column.related_field_name = RelationalMatch.objects.get(
+                import_log=import_log,
+                field_name=column.field.name,
+            ).related_field_name
+        column.set_field(new_object, cell)
+
+
+def set_method_from_cell(import_log, new_object, header_row_field_name, cell):
+    """ Run a method from a import cell.
+    """
+    if header_row_field_name.startswith('simple_import_method__'):
+        getattr(new_object, header_row_field_name[22:])(cell)
+
+
+def describe_error(exc):
+    """ Error Type and Error Details columns for a row that failed """
+    if isinstance(exc, IntegrityError):
+        return ["Integrity Error", smart_text(exc)]
+    if isinstance(exc, ParseError):
+        return ["Invalid " + exc.type_name, "; ".join(smart_text(message) for message in exc.messages)]
+    if isinstance(exc, ValidationError):
+        return ["Validation Error", "; ".join(smart_text(message) for message in exc.messages)]
+    if isinstance(exc, ObjectDoesNotExist):
+        return ["No Record Found to Update", smart_text(exc)]
+    if isinstance(exc, ValueError):
+        if str(exc).startswith('invalid literal for int() with base 10'):
+            return ["Incompatible Data - A number was expected, but a character was used", smart_text(exc)]
+        return ["Value Error", smart_text(exc)]
+    return ["Unknown Error"]
+
+
+class ErrorReport(object):
+    """ Failed rows written to a temporary file as they happen instead of
+    kept in memory. save() streams them into a write-only openpyxl workbook,
+    or a csv file when openpyxl isn't installed, stored as the ImportLog's
+    error_file. """
+    def __init__(self, header_row):
+        self.header_row = header_row
+        self.rows = tempfile.TemporaryFile()
+
+    def append(self, row):
+        self.rows.seek(0, io.SEEK_END)
+        pickle.dump(row, self.rows, pickle.HIGHEST_PROTOCOL)
+
+    def __iter__(self):
+        yield self.header_row
+        self.rows.seek(0)
+        while True:
+            try:
+                yield pickle.load(self.rows)
+            except EOFError:
+                return
+
+    def save(self, import_log):
+        """ Store the report as import_log.error_file, replacing the last
+        one. The ImportLog itself isn't saved. """
+        from django.core.files import File
+
+        if import_log.error_file:
+            import_log.error_file.delete(save=False)
+        with tempfile.TemporaryFile() as error_file:
+            try:
+                from openpyxl.workbook import Workbook
+            except ImportError:
+                text_file = io.TextIOWrapper(error_file, encoding='utf-8', newline='')
+                csv.writer(text_file).writerows(self)
+                text_file.flush()
+                text_file.detach()
+                filename = 'Errors.csv'
+            else:
+                wb = Workbook(write_only=True)
+                ws = wb.create_sheet("Errors")
+                for row in self:
+                    ws.append(row)
+                wb.save(error_file)
+                filename = 'Errors.xlsx'
+            error_file.seek(0)
+            import_log.error_file.save(filename, File(error_file), save=False)
+
+
+def use_compact_tracking(model_class):
+    """ Record imported objects in ImportedBlocks rather than ImportedObjects,
+    when asked to or when ImportedObject.object_id can't hold the keys """
+    if getattr(settings, 'SIMPLE_IMPORT_COMPACT_TRACKING', False):
+        return True
+    pk_field = model_class._meta.pk
+    while pk_field.is_relation:
+        pk_field = pk_field.target_field
+    return pk_field.get_internal_type() not in IMPORTED_OBJECT_KEY_TYPES
+
+
+def can_return_bulk_pks():
+    """ bulk_create only sets primary keys on some backends, and we need
+    them to log the import and to be able to undo it """
+    features = connection.features
+    return bool(
+        getattr(features, 'can_return_rows_from_bulk_insert', False) or
+        getattr(features, 'can_return_ids_from_bulk_insert', False))
+
+
+class Importer(object):
+    """ Run an import for an ImportLog. Counts and failed rows are collected
+    on the instance so the view can report them. """
+    def __init__(self, import_log, user, commit=False, progress=None, resume=False):
+        self.import_log = import_log
+        self.user = user
+        self.commit = commit
+        self.progress = progress
+        self.resume = resume
+        self.content_type = import_log.import_setting.content_type
+        self.model_class = self.content_type.model_class()
+        self.batch_size = getattr(settings, 'SIMPLE_IMPORT_BATCH_SIZE', 500)
+        self.rows_done = 0
+        self.create_count = 0
+        self.update_count = 0
+        self.fail_count = 0
+        # The first failed rows, all of them are written to error_report
+        self.error_data = []
+        self.error_report = None
+        self.error_preview_size = getattr(settings, 'SIMPLE_IMPORT_ERROR_PREVIEW_SIZE', 100)
+        self.compact_tracking = use_compact_tracking(self.model_class)
+        self.tracked_keys = []
+        self.started = time.time()
+
+    def run(self):
+        import_rows = self.import_log.iter_import_rows()
+        header_row = next(import_rows, [])
+        self.prepare(header_row)
+
+        commit_chunk_size = getattr(settings, 'SIMPLE_IMPORT_COMMIT_CHUNK_SIZE', None)
+        if self.can_validate_only():
+            self.validate_rows(import_rows)
+        elif self.can_run_parallel():
+            self.run_parallel(import_rows, header_row)
+        elif self.commit and commit_chunk_size:
+            self.run_chunked_commits(import_rows, commit_chunk_size)
+        else:
+            with transaction.atomic():
+                sid = transaction.savepoint()
+                self.import_rows(import_rows)
+                if not self.commit:
+                    transaction.savepoint_rollback(sid)
+        return self
+
+    def run_chunked_commits(self, import_rows, commit_chunk_size):
+        """ Commit every commit_chunk_size rows and checkpoint the offset on
+        the ImportLog in the same transaction, so an interrupted import can
+        resume after the last committed row. When the rows come straight
+        from a csv file its byte offset is saved too, to resume from there
+        without parsing the rows before it. """
+        import_log = self.import_log
+        if self.resume:
+            self.rows_done = import_log.last_committed_row
+            self.create_count = import_log.create_count
+            self.update_count = import_log.update_count
+            self.fail_count = import_log.fail_count
+            spool = import_log.open_spool()
+            if spool is not None:
+                # Seek straight to the first row that isn't committed
+                import_rows.close()
+                import_rows = spool_rows(spool, self.rows_done + 1)
+            elif import_log.last_committed_offset:
+                import_rows.close()
+                import_rows = import_log.parse_import_rows(import_log.last_committed_offset)
+                # The header was read already
+                next(import_rows, None)
+            else:
+                import_rows = islice(import_rows, self.rows_done, None)
+        else:
+            import_log.last_committed_row = 0
+            import_log.last_committed_offset = None
+        for chunk in chunked(import_rows, commit_chunk_size):
+            with transaction.atomic():
+                self.import_rows(chunk)
+                import_log.last_committed_row = self.rows_done
+                import_log.last_committed_offset = getattr(import_log, 'read_offset', None)
+                ImportLog.objects.filter(pk=import_log.pk).update(
+                    last_committed_row=self.rows_done,
+                    last_committed_offset=import_log.last_committed_offset,
+                    create_count=self.create_count,
+                    update_count=self.update_count,
+                    fail_count=self.fail_count)
+
+    def can_run_parallel(self):
+        """ Rows can only be split between processes when their order
+        doesn't matter and the database takes concurrent writers """
+        if getattr(settings, 'SIMPLE_IMPORT_PARALLEL_WORKERS', 1) < 2:
+            return False
+        if (connection.vendor == 'sqlite' or connection.in_atomic_block or
+                self.resume):
+            return False
+        # A repeated key could be created by two workers at once
+        if self.import_log.import_type == "U":
+            return False
+        # Rows may refer to records created by earlier rows
+        return not any(
+            column.related_model is self.model_class
+            for column in self.columns if column is not None)
+
+    def run_parallel(self, import_rows, header_row):
+        """ Split the rows into partitions and import them in a process pool.
+        Every worker has its own connection and commits (or rolls back) each
+        partition on its own. Counts and failed rows are merged back here.
+        When the file is already spooled, workers are only sent row ranges
+        and read the rows from the spool themselves. """
+        from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+        import multiprocessing
+
+        workers = getattr(settings, 'SIMPLE_IMPORT_PARALLEL_WORKERS', 1)
+        partition_size = getattr(
+            settings, 'SIMPLE_IMPORT_PARTITION_SIZE', self.batch_size * 10)
+        failed_rows = {}
+        next_index = [0]
+
+        def collect(futures):
+            for future in futures:
+                index, partition_rows = pending.pop(future)
+                result = future.result()
+                self.create_count += result['create_count']
+                self.update_count += result['update_count']
+                self.fail_count += result['fail_count']
+                failed_rows[index] = result['error_data']
+                self.chunk_done(partition_rows)
+            # Report failed rows in file order, as soon as the partitions
+            # before them are done
+            while next_index[0] in failed_rows:
+                for error_row in failed_rows.pop(next_index[0]):
+                    self.add_error_row(error_row)
+                next_index[0] += 1
+
+        # Workers open their own connections, don't hand them ours. Spawned
+        # rather than forked so no connection state is shared at all.
+        connections.close_all()
+        spool = self.import_log.open_spool()
+        if spool is not None:
+            with spool:
+                row_count = len(spool)
+            import_rows.close()
+            # Row 0 of the spool is the header
+            partitions = (
+                range(start, min(start + partition_size, row_count))
+                for start in range(1, row_count, partition_size))
+        else:
+            partitions = chunked(import_rows, partition_size)
+        pending = {}
+        with ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=django.setup) as executor:
+            for index, partition in enumerate(partitions):
+                # Don't read further ahead of the workers than we need to
+                if len(pending) >= workers * 2:
+                    collect(wait(pending, return_when=FIRST_COMPLETED).done)
+                future = executor.submit(
+                    import_partition, self.import_log.pk, self.user.pk,
+                    self.commit, header_row, partition)
+                pending[future] = (index, partition)
+            while pending:
+                collect(wait(pending).done)
+
+    def import_rows(self, rows):
+        rows = self.parse_rows(rows)
+        if self.can_bulk_create():
+            self.bulk_create_rows(rows)
+        elif self.can_bulk_upsert():
+            self.bulk_upsert_rows(rows)
+        else:
+            for chunk in chunked(rows, self.batch_size):
+                self.load_related_keys(chunk)
+                for row in chunk:
+                    self.import_row(row)
+                self.chunk_done(chunk)
+
+    def save_error_file(self):
+        """ Save the failed rows as a spreadsheet on the ImportLog """
+        self.error_report.save(self.import_log)
+
+    def get_progress(self):
+        """ Progress fields as saved on ImportLog """
+        elapsed = time.time() - self.started
+        return {
+            'rows_done': self.rows_done,
+            'create_count': self.create_count,
+            'update_count': self.update_count,
+            'fail_count': self.fail_count,
+            'rows_per_second': self.rows_done / elapsed if elapsed else 0,
+        }
+
+    def chunk_done(self, chunk):
+        if self.tracked_keys:
+            ImportedBlock.from_keys(
+                self.import_log, self.content_type, self.tracked_keys).save()
+            self.tracked_keys = []
+        self.rows_done += len(chunk)
+        if self.progress is not None:
+            self.progress(self)
+
+    def prepare(self, header_row):
+        """ Resolve the import plan for the header row """
+        import_log = self.import_log
+        error_header = header_row + ['Error Type', 'Error Details']
+        self.error_data = [error_header]
+        self.error_report = ErrorReport(error_header)
+        column_matches = import_log.import_setting.get_column_matches()
+        self.columns = build_import_plan(
+            import_log, self.model_class, header_row, column_matches)
+        index_related_keys(self.columns)
+        is_empty = import_log.is_empty
+        self.field_converters = [
+            column.compile(is_empty) if column is not None else None
+            for column in self.columns]
+        self.method_converters = [
+            column.compile(is_empty, methods=True) if column is not None else None
+            for column in self.columns]
+        self.m2m_columns = {
+            column.field_name: column for column in self.columns
+            if column is not None and column.kind == ImportColumn.M2M}
+        self.column_parsers = []
+        if getattr(settings, 'SIMPLE_IMPORT_TYPED_PARSING', False):
+            for i, column in enumerate(self.columns):
+                if column is None or column.kind not in (ImportColumn.PLAIN, ImportColumn.BOOLEAN):
+                    continue
+                type_name = get_parse_type(column.field)
+                if type_name is not None:
+                    self.column_parsers += [
+                        ColumnParser(i, header_row[i], column.field, type_name, is_empty)]
+        key_column_name = None
+        if import_log.update_key and import_log.import_type in ["U", "O"]:
+            key_match = column_matches.find(import_log.update_key)
+            if key_match is None:
+                raise ColumnMatch.DoesNotExist(
+                    "No column matches the update key %s" % import_log.update_key)
+            key_column_name = key_match.column_name
+            self.key_field_name = key_match.field_name
+        for i, cell in enumerate(header_row):
+            if key_column_name != None and key_column_name.lower() == cell.lower():
+                self.key_index = i
+
+    def add_error(self, row, exc):
+        self.add_error_row(row + describe_error(exc))
+        self.fail_count += 1
+
+    def add_error_row(self, error_row):
+        # error_data[0] is the header
+        if len(self.error_data) <= self.error_preview_size:
+            self.error_data += [error_row]
+        self.error_report.append(error_row)
+
+    def parse_rows(self, rows):
+        """ Convert the typed columns a chunk of rows at a time. Rows with a
+        cell that doesn't convert are reported and counted as done here, the
+        rest are yielded with typed cells. """
+        if not self.column_parsers:
+            return rows
+        return self.iter_parsed_rows(rows)
+
+    def iter_parsed_rows(self, rows):
+        for chunk in chunked(rows, self.batch_size):
+            parsed_rows, errors = parse_chunk(self.column_parsers, chunk)
+            for row, exc in errors:
+                self.add_error(row, exc)
+            self.rows_done += len(errors)
+            yield from parsed_rows
+
+    def set_fields(self, new_object, row, methods=False):
+        converters = self.method_converters if methods else self.field_converters
+        for convert, cell in zip(converters, row):
+            if convert is not None:
+                convert(new_object, cell)
+
+    def load_related_keys(self, rows):
+        """ Fill the related key indexes for a chunk of rows up front """
+        for i, column in enumerate(self.columns):
+            if column is None or column.key_index is None:
+                continue
+            cells = [row[i] for row in rows if i < len(row)]
+            if column.default_value:
+                cells += [column.default_value]
+            column.key_index.load(cells)
+
+    def resolve_m2ms(self, new_object):
+        """ (column, related object) pairs for the object's m2m cells """
+        return [
+            (self.m2m_columns[key], self.m2m_columns[key].get_related_object(value))
+            for key, value in new_object.simple_import_m2ms.items()]
+
+    def set_m2ms(self, new_object):
+        for column, related_object in self.resolve_m2ms(new_object):
+            getattr(new_object, column.field_name).add(related_object)
+
+    def add_m2ms(self, objects):
+        """ Link the m2m values resolved in prepare_object for a batch of
+        saved objects, with one insert per through table. Fields with
+        m2m_changed receivers go through add() so they still get the signal. """
+        through_objects = OrderedDict()
+        for new_object in objects:
+            for column, related_object in new_object.simple_import_m2m_links:
+                if (column.through is None or not SUPPORTS_IGNORE_CONFLICTS or
+                        m2m_changed.has_listeners(column.through)):
+                    getattr(new_object, column.field_name).add(related_object)
+                    continue
+                field = column.field
+                through_objects.setdefault(column.through, []).append(column.through(**{
+                    field.m2m_field_name(): new_object,
+                    field.m2m_reverse_field_name(): related_object,
+                }))
+        for through, links in through_objects.items():
+            # Updated records may already have some of the links
+            through._default_manager.bulk_create(links, ignore_conflicts=True)
+
+    def import_row(self, row):
+        """ Save a single row in its own savepoint """
+        import_log = self.import_log
+        model_class = self.model_class
+        try:
+            with transaction.atomic():
+                is_created = True
+                if import_log.import_type == "N":
+                    new_object = model_class()
+                elif import_log.import_type == "O":
+                    filters = {self.key_field_name: row[self.key_index]}
+                    new_object = model_class.objects.get(**filters)
+                    is_created = False
+                elif import_log.import_type == "U":
+                    filters = {self.key_field_name: row[self.key_index]}
+                    new_object = model_class.objects.filter(**filters).first()
+                    if new_object == None:
+                        new_object = model_class()
+                    else:
+                        is_created = False
+
+                new_object.simple_import_m2ms = {} # Need to deal with these after saving
+                self.set_fields(new_object, row)
+                new_object.save()
+                self.set_fields(new_object, row, methods=True)
+                new_object.save()
+                self.set_m2ms(new_object)
+
+                LogEntry.objects.log_action(
+                    user_id         = self.user.pk,
+                    content_type_id = ContentType.objects.get_for_model(new_object).pk,
+                    object_id       = new_object.pk,
+                    object_repr     = smart_text(new_object),
+                    action_flag     = ADDITION if is_created else CHANGE
+                )
+                if not self.compact_tracking:
+                    ImportedObject.objects.create(
+                        import_log = import_log,
+                        object_id = new_object.pk,
+                        content_type = self.content_type)
+        except Exception as exc:
+            self.add_error(row, exc)
+        else:
+            if is_created:
+                self.create_count += 1
+            else:
+                self.update_count += 1
+            if self.compact_tracking:
+                # Written as one ImportedBlock when the chunk is done
+                self.tracked_keys += [new_object.pk]
+
+    def is_plain_model(self):
+        """ Batched writes skip save() and its signals, so they are only used
+        for plain models where nothing would notice the difference """
+        model_class = self.model_class
+        return bool(
+            not hasattr(model_class, 'simple_import_methods') and
+            not any(column.kind == ImportColumn.METHOD
+                    for column in self.columns if column is not None) and
+            model_class.save is models.Model.save and
+            not model_class._meta.parents and
+            not pre_save.has_listeners(model_class) and
+            not post_save.has_listeners(model_class))
+
+    def can_bulk_create(self):
+        return bool(
+            getattr(settings, 'SIMPLE_IMPORT_BULK_CREATE', True) and
+            self.import_log.import_type == "N" and
+            can_return_bulk_pks() and
+            self.is_plain_model())
+
+    def can_bulk_upsert(self):
+        """ Updates only need bulk_update, creating missing records ("U")
+        also needs primary keys back from bulk inserts """
+        if not (getattr(settings, 'SIMPLE_IMPORT_BULK_UPSERT', True) and
+                self.import_log.import_type in ["U", "O"] and
+                getattr(self, 'key_field_name', None) and
+                hasattr(models.QuerySet, 'bulk_update')):
+            return False
+        if self.import_log.import_type == "U" and not can_return_bulk_pks():
+            return False
+        key_field = self.model_class._meta.get_field(self.key_field_name)
+        if not key_field.concrete or key_field.is_relation:
+            return False
+        return self.is_plain_model()
+
+    def can_validate_only(self):
+        """ A simulation can check rows without writing them when nothing
+        but the fields would run on save. Import methods, custom save() and
+        signal receivers could fail or change data, so those models are
+        simulated by saving and rolling back. """
+        if self.commit or not getattr(settings, 'SIMPLE_IMPORT_VALIDATE_DRY_RUN', True):
+            return False
+        if (self.import_log.import_type in ["U", "O"] and
+                not getattr(self, 'key_field_name', None)):
+            return False
+        return self.is_plain_model()
+
+    def validate_rows(self, rows):
+        """ Simulate the import in memory. Each cell goes through its
+        column's converter and its field's clean(), relations and update
+        keys are looked up in key indexes, and unique values are checked
+        against the rest of the file and the database. New objects must have
+        a value for every NOT NULL field. Nothing is written, failed rows get
+        the same error_data as a real import. """
+        model_class = self.model_class
+        import_type = self.import_log.import_type
+        self.clean_fields = []
+        unique_fields = []
+        for i, column in enumerate(self.columns):
+            if column is None or column.field is None or column.field.is_relation:
+                continue
+            field = column.field
+            self.clean_fields += [field]
+            if field.unique and not field.primary_key:
+                unique_fields += [(i, field, RelatedKeyIndex(model_class, field.name), {})]
+        key_index = None
+        if import_type in ["U", "O"]:
+            key_index = RelatedKeyIndex(model_class, self.key_field_name)
+            key_field = model_class._meta.get_field(self.key_field_name)
+            # Keys created by earlier rows, later rows update them
+            created_keys = set()
+
+        for chunk in chunked(self.parse_rows(rows), self.batch_size):
+            self.load_related_keys(chunk)
+            for i, field, unique_index, seen in unique_fields:
+                unique_index.load([row[i] for row in chunk if i < len(row)])
+            if key_index is not None:
+                key_index.load([row[self.key_index] for row in chunk])
+            for row in chunk:
+                try:
+                    is_created = True
+                    key = existing = None
+                    if key_index is not None:
+                        key = key_field.to_python(row[self.key_index])
+                        try:
+                            existing = key_index.get(key)
+                            is_created = False
+                        except model_class.DoesNotExist:
+                            if import_type == "O":
+                                raise
+                            is_created = key not in created_keys
+                    new_object = model_class()
+                    new_object.simple_import_m2ms = {}
+                    self.set_fields(new_object, row)
+                    self.resolve_m2ms(new_object)
+                    self.clean_object(new_object)
+                    if is_created:
+                        self.check_required(new_object)
+                    unique_values = [
+                        (seen, self.check_unique(new_object, field, unique_index, seen, key, existing))
+                        for i, field, unique_index, seen in unique_fields]
+                except Exception as exc:
+                    self.add_error(row, exc)
+                    continue
+                # Only rows that would have been saved take up their values
+                for seen, value in unique_values:
+                    if value is not None:
+                        seen[value] = key
+                if is_created:
+                    if key_index is not None:
+                        created_keys.add(key)
+                    self.create_count += 1
+                else:
+                    self.update_count += 1
+            self.chunk_done(chunk)
+
+    def clean_object(self, new_object):
+        """ Run clean() for the fields set from the file. Blank values are
+        left to the database like a real save would, so only a missing
+        NOT NULL value fails. """
+        opts = self.model_class._meta
+        for field in self.clean_fields:
+            value = getattr(new_object, field.attname)
+            if value is None:
+                if not field.null:
+                    raise IntegrityError("NOT NULL constraint failed: %s.%s" % (
+                        opts.db_table, field.column))
+                continue
+            if value in field.empty_values:
+                continue
+            setattr(new_object, field.attname, field.clean(value, new_object))
+
+    def check_required(self, new_object):
+        """ Raise like the INSERT would if a NOT NULL field of a new object
+        is neither in the file nor has a default """
+        opts = self.model_class._meta
+        for field in opts.local_concrete_fields:
+            if (field.null or field.primary_key or
+                    getattr(field, 'auto_now', False) or getattr(field, 'auto_now_add', False)):
+                continue
+            if getattr(new_object, field.attname) is None:
+                raise IntegrityError("NOT NULL constraint failed: %s.%s" % (
+                    opts.db_table, field.column))
+
+    def check_unique(self, new_object, field, unique_index, seen, key=None, existing=None):
+        """ Raise if a unique value is repeated in the file or already in the
+        database, otherwise return the value. seen maps the values taken by
+        earlier rows to their update key. Rows with the same key are the same
+        object, and so is existing, the object the row updates. """
+        value = getattr(new_object, field.attname)
+        if value is None:
+            return None
+        if value in seen and (key is None or seen[value] != key):
+            raise IntegrityError("Duplicate %s %r in the import file" % (
+                field.verbose_name, value))
+        try:
+            taken_by = unique_index.get(value)
+        except self.model_class.DoesNotExist:
+            return value
+        if existing is not None and taken_by.pk == existing.pk:
+            return value
+        raise IntegrityError("%s with %s %r already exists" % (
+            self.model_class._meta.object_name, field.verbose_name, value))
+
+    def build_object(self, row):
+        """ Create an unsaved object from a row and run each field's database
+        conversion so bad values fail here instead of failing a whole batch """
+        new_object = self.model_class()
+        new_object.simple_import_m2ms = {}
+        self.set_fields(new_object, row)
+        self.prepare_object(new_object)
+        return new_object
+
+    def prepare_object(self, new_object):
+        new_object.simple_import_m2m_links = self.resolve_m2ms(new_object)
+        for field in self.model_class._meta.local_concrete_fields:
+            if field.primary_key and getattr(new_object, field.attname) is None:
+                continue
+            field.get_db_prep_save(getattr(new_object, field.attname), connection)
+
+    def bulk_create_rows(self, rows):
+        for chunk in chunked(rows, self.batch_size):
+            self.load_related_keys(chunk)
+            batch = []
+            for row in chunk:
+                try:
+                    batch += [(row, self.build_object(row))]
+                except Exception as exc:
+                    self.add_error(row, exc)
+            if batch:
+                self.write_batch(batch)
+            self.chunk_done(chunk)
+
+    def write_batch(self, batch, update=False):
+        """ Insert (or update) a batch of (row, object) pairs. If the batch
+        fails split it in half and retry so only the bad rows end up in
+        error_data. """
+        # Keys from the file, or None where the database assigns them
+        pks = [new_object.pk for row, new_object in batch]
+        try:
+            with transaction.atomic():
+                if update:
+                    self.update_objects([new_object for row, new_object in batch])
+                else:
+                    self.insert_objects([new_object for row, new_object in batch])
+        except Exception as exc:
+            if not update:
+                for (row, new_object), pk in zip(batch, pks):
+                    # Forget any primary keys from the rolled back insert
+                    new_object.pk = pk
+                    new_object._state.adding = True
+                    new_object._state.db = None
+            if len(batch) == 1:
+                self.add_error(batch[0][0], exc)
+            else:
+                middle = len(batch) // 2
+                self.write_batch(batch[:middle], update=update)
+                self.write_batch(batch[middle:], update=update)
+        else:
+            if update:
+                self.update_count += len(batch)
+            else:
+                self.create_count += len(batch)
+
+    def insert_objects(self, objects):
+        objects = self.model_class.objects.bulk_create(objects)
+        self.log_objects(objects, ADDITION)
+
+    def update_objects(self, objects):
+        for new_object in objects:
+            # bulk_update doesn't call pre_save so auto_now isn't applied
+            for field in self.auto_now_fields:
+                setattr(new_object, field.attname, field.pre_save(new_object, False))
+        # Only m2m columns besides the key leave nothing to update
+        if self.update_fields:
+            self.model_class.objects.bulk_update(objects, self.update_fields)
+        self.log_objects(objects, CHANGE)
+
+    def log_objects(self, objects, action_flag):
+        self.add_m2ms(objects)
+        if self.compact_tracking:
+            ImportedBlock.from_keys(
+                self.import_log, self.content_type,
+                [new_object.pk for new_object in objects]).save()
+        else:
+            ImportedObject.objects.bulk_create([
+                ImportedObject(
+                    import_log=self.import_log,
+                    object_id=new_object.pk,
+                    content_type=self.content_type)
+                for new_object in objects])
+        LogEntry.objects.bulk_create([
+            LogEntry(
+                user_id=self.user.pk,
+                content_type_id=self.content_type.pk,
+                object_id=smart_text(new_object.pk),
+                object_repr=smart_text(new_object)[:200],
+                action_flag=action_flag)
+            for new_object in objects])
+
+    def bulk_upsert_rows(self, rows):
+        """ Create and update, or only update, records in chunks. Existing
+        records for a chunk are fetched with a single key__in query. """
+        opts = self.model_class._meta
+        key_field = opts.get_field(self.key_field_name)
+        self.update_fields = []
+        for column in self.columns:
+            if column is None or column.field is None:
+                continue
+            field = column.field
+            if field.concrete and not field.many_to_many and not field.primary_key:
+                self.update_fields += [field.name]
+        self.auto_now_fields = [
+            field for field in opts.local_concrete_fields
+            if getattr(field, 'auto_now', False)]
+        self.update_fields += [
+            field.name for field in self.auto_now_fields
+            if field.name not in self.update_fields]
+
+        for chunk in chunked(rows, self.batch_size):
+            self.load_related_keys(chunk)
+            keyed_rows = []
+            seen_keys = set()
+            for row in chunk:
+                try:
+                    key = key_field.to_python(row[self.key_index])
+                except Exception as exc:
+                    self.add_error(row, exc)
+                    continue
+                if key in seen_keys:
+                    # A repeated key has to see the earlier row's write
+                    self.upsert_chunk(key_field, keyed_rows)
+                    keyed_rows = []
+                    seen_keys = set()
+                keyed_rows += [(key, row)]
+                seen_keys.add(key)
+            self.upsert_chunk(key_field, keyed_rows)
+            self.chunk_done(chunk)
+
+    def upsert_chunk(self, key_field, keyed_rows):
+        if not keyed_rows:
+            return
+        manager = self.model_class._default_manager
+        existing_objects = {
+            getattr(existing_object, key_field.attname): existing_object
+            for existing_object in manager.filter(**{
+                key_field.name + '__in': [key for key, row in keyed_rows]})}
+        # Records the database matched to a key that isn't equal in python,
+        # like "ABC" and "abc" under a case insensitive MySQL collation
+        unclaimed = set(existing_objects).difference(key for key, row in keyed_rows)
+        creates = []
+        updates = []
+        for key, row in keyed_rows:
+            try:
+                new_object = existing_objects.get(key)
+                if new_object is None and unclaimed:
+                    new_object = manager.filter(**{key_field.name: key}).first()
+                    if new_object is not None:
+                        new_object = existing_objects.get(
+                            getattr(new_object, key_field.attname), new_object)
+                if new_object is None:
+                    if self.import_log.import_type == "O":
+                        raise self.model_class.DoesNotExist(
+                            "%s matching query does not exist." %
+                            self.model_class._meta.object_name)
+                    creates += [(row, self.build_object(row))]
+                else:
+                    new_object.simple_import_m2ms = {}
+                    self.set_fields(new_object, row)
+                    self.prepare_object(new_object)
+                    updates += [(row, new_object)]
+            except Exception as exc:
+                self.add_error(row, exc)
+        if creates:
+            self.write_batch(creates)
+        if updates:
+            self.write_batch(updates, update=True)
+
+
+_partition_importer = None
+
+
+def spool_rows(spool, start=0, stop=None):
+    """ Yield rows from a Spool and close it once they're read """
+    with spool:
+        yield from spool.iter_rows(start, stop)
+
+
+def import_partition(import_log_id, user_id, commit, header_row, rows):
+    """ Import one partition of rows in a worker process. rows is either the
+    rows themselves or a range of rows to read from the import's spool. The
+    prepared Importer is kept for the next partition of the same import. """
+    global _partition_importer
+    importer = _partition_importer
+    if (importer is None or importer.import_log.pk != import_log_id or
+            importer.commit != commit):
+        import_log = ImportLog.objects.get(pk=import_log_id)
+        user = get_user_model().objects.get(pk=user_id)
+        importer = Importer(import_log, user, commit=commit)
+        importer.prepare(header_row)
+        _partition_importer = importer
+    importer.create_count = importer.update_count = importer.fail_count = 0
+    importer.error_data = []
+    # Failed rows go back to the parent process, which writes the report
+    importer.error_report = []
+    if isinstance(rows, range):
+        spool = importer.import_log.open_spool()
+        if spool is None:
+            raise ValueError("Import {0} has no spool to read rows from".format(import_log_id))
+        with spool:
+            rows = list(spool.iter_rows(rows.start, rows.stop))
+    with transaction.atomic():
+        sid = transaction.savepoint()
+        importer.import_rows(rows)
+        if not commit:
+            transaction.savepoint_rollback(sid)
+    return {
+        'create_count': importer.create_count,
+        'update_count': importer.update_count,
+        'fail_count': importer.fail_count,
+        'error_data': importer.error_report,
+    }
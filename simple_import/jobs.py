@@ -0,0 +1,199 @@
+""" Run imports, and undo them, outside of the request/response cycle
+do_import hands the work to a job runner and the page polls the
+simple_import-import_status view for progress saved on the ImportLog.
+
+The runner is set with SIMPLE_IMPORT_JOB_RUNNER, a dotted path to a class
+with a submit(func, *args) method. func is always a module level function
+of this module and args are plain ints and bools, so a runner for a task
+queue only has to send them to a task that calls func(*args).
+"""
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import queue
+import threading
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import connection, DatabaseError
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from .importer import Importer
+from .models import ImportLog
+
+logger = logging.getLogger(__name__)
+
+# Seconds between heartbeats while a job runs, see ImportLog.fail_if_stale
+HEARTBEAT_INTERVAL = 30
+
+
+class ThreadRunner(object):
+    """ Run jobs on a thread pool shared by the process """
+    executor = None
+    lock = threading.Lock()
+
+    def get_executor(self):
+        with self.lock:
+            if ThreadRunner.executor is None:
+                ThreadRunner.executor = ThreadPoolExecutor(
+                    max_workers=getattr(settings, 'SIMPLE_IMPORT_JOB_WORKERS', 4))
+            return ThreadRunner.executor
+
+    def submit(self, func, *args):
+        self.get_executor().submit(run_in_thread, func, *args)
+
+
+class ImmediateRunner(object):
+    """ Run jobs inline, inside the request """
+    def submit(self, func, *args):
+        func(*args)
+
+
+def get_job_runner():
+    runner = getattr(settings, 'SIMPLE_IMPORT_JOB_RUNNER', 'simple_import.jobs.ThreadRunner')
+    return import_string(runner)()
+
+
+def run_in_thread(func, *args):
+    try:
+        func(*args)
+    except Exception:
+        logger.exception("simple_import job failed")
+    finally:
+        # Each pool thread has its own connection, don't leak it
+        connection.close()
+
+
+class ProgressWriter(object):
+    """ Save import progress on the ImportLog from a separate thread.
+    The import runs inside a transaction, so progress saved on the job's own
+    connection wouldn't be visible to the status view until it's over.
+    Every save is a heartbeat, and one is sent every HEARTBEAT_INTERVAL
+    seconds even without progress, like while a slow chunk or an undo runs. """
+    def __init__(self, import_log_id):
+        self.import_log_id = import_log_id
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.write, daemon=True)
+        self.thread.start()
+
+    def __call__(self, importer):
+        self.queue.put(importer.get_progress())
+
+    def save(self, fields):
+        try:
+            ImportLog.objects.filter(pk=self.import_log_id).update(
+                heartbeat=timezone.now(), **fields)
+        except DatabaseError:
+            logger.warning("Could not save import progress", exc_info=True)
+
+    def write(self):
+        try:
+            while True:
+                try:
+                    fields = self.queue.get(timeout=HEARTBEAT_INTERVAL)
+                except queue.Empty:
+                    fields = {}
+                if fields is None:
+                    break
+                closing = False
+                # Only the latest progress matters
+                while not self.queue.empty():
+                    latest = self.queue.get_nowait()
+                    if latest is None:
+                        closing = True
+                    else:
+                        fields = latest
+                self.save(fields)
+                if closing:
+                    break
+        finally:
+            connection.close()
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+
+class InlineProgressWriter(ProgressWriter):
+    """ Save progress on the import's own connection. sqlite only allows one
+    writer at a time, so a second connection would just wait on the import's
+    lock. """
+    def __init__(self, import_log_id):
+        self.import_log_id = import_log_id
+
+    def __call__(self, importer):
+        self.save(importer.get_progress())
+
+    def close(self):
+        pass
+
+
+def get_progress_writer(import_log_id):
+    if connection.vendor == 'sqlite':
+        return InlineProgressWriter(import_log_id)
+    return ProgressWriter(import_log_id)
+
+
+def enqueue_import(import_log, user, commit=False, resume=False):
+    """ Mark the import as queued and hand it to the job runner. resume
+    continues a chunked commit import after its last committed row.
+    Returns False, and runs nothing, if a job for it is already queued or
+    running. """
+    fields = {'commit': commit, 'rows_per_second': 0}
+    if not resume:
+        fields.update(
+            rows_done=0, create_count=0, update_count=0, fail_count=0, last_committed_row=0,
+            last_committed_offset=None)
+    if not import_log.claim("queued", **fields):
+        return False
+    get_job_runner().submit(run_import_job, import_log.id, user.pk, commit, resume)
+    return True
+
+
+def run_import_job(import_log_id, user_id, commit, resume=False):
+    import_log = ImportLog.objects.get(id=import_log_id)
+    user = get_user_model().objects.get(pk=user_id)
+    ImportLog.objects.filter(pk=import_log.pk).update(status="running", heartbeat=timezone.now())
+    progress = get_progress_writer(import_log.pk)
+    importer = Importer(import_log, user, commit=commit, progress=progress, resume=resume)
+    try:
+        try:
+            importer.run()
+        finally:
+            progress.close()
+        for field, value in importer.get_progress().items():
+            setattr(import_log, field, value)
+        import_log.status = "done"
+        if importer.fail_count:
+            importer.save_error_file()
+        import_log.save()
+    except Exception:
+        ImportLog.objects.filter(pk=import_log.pk).update(status="failed")
+        raise
+    return importer
+
+
+def enqueue_undo(import_log):
+    """ Mark the import as being undone and hand the undo to the job runner.
+    Returns False if a job for it is already queued or running. """
+    if not import_log.claim("undoing"):
+        return False
+    get_job_runner().submit(run_undo_job, import_log.id)
+    return True
+
+
+def run_undo_job(import_log_id):
+    import_log = ImportLog.objects.get(id=import_log_id)
+    # Only for the heartbeats
+    progress = get_progress_writer(import_log.pk)
+    try:
+        try:
+            import_log.undo()
+        finally:
+            progress.close()
+    except Exception:
+        ImportLog.objects.filter(pk=import_log.pk).update(status="failed")
+        raise
+    ImportLog.objects.filter(pk=import_log.pk).update(
+        status="", commit=False, create_count=0, update_count=0, fail_count=0,
+        rows_done=0, last_committed_row=0, last_committed_offset=None)
@@ -0,0 +1,48 @@
+# Generated by Django 3.0.14 on 2026-10-18 14:54
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('simple_import', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='importlog',
+            name='commit',
+            field=models.BooleanField(blank=True, default=False, editable=False),
+        ),
+        migrations.AddField(
+            model_name='importlog',
+            name='create_count',
+            field=models.IntegerField(blank=True, default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='importlog',
+            name='fail_count',
+            field=models.IntegerField(blank=True, default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='importlog',
+            name='rows_done',
+            field=models.IntegerField(blank=True, default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='importlog',
+            name='rows_per_second',
+            field=models.FloatField(blank=True, default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='importlog',
+            name='status',
+            field=models.CharField(blank=True, choices=[('', 'Not Started'), ('queued', 'Queued'), ('running', 'Running'), ('done', 'Done'), ('failed', 'Failed')], editable=False, max_length=10),
+        ),
+        migrations.AddField(
+            model_name='importlog',
+            name='update_count',
+            field=models.IntegerField(blank=True, default=0, editable=False),
+        ),
+    ]
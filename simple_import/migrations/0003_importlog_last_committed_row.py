@@ -0,0 +1,18 @@
+# Generated by Django 3.0.14 on 2026-10-18 14:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('simple_import', '0002_import_progress'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='importlog',
+            name='last_committed_row',
+            field=models.IntegerField(blank=True, default=0, editable=False, help_text='Rows committed so far when SIMPLE_IMPORT_COMMIT_CHUNK_SIZE is set'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.0.14 on 2026-10-18 15:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('simple_import', '0003_importlog_last_committed_row'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='importlog',
+            name='status',
+            field=models.CharField(blank=True, choices=[('', 'Not Started'), ('queued', 'Queued'), ('running', 'Running'), ('undoing', 'Undoing'), ('done', 'Done'), ('failed', 'Failed')], editable=False, max_length=10),
+        ),
+    ]
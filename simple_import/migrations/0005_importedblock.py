@@ -0,0 +1,25 @@
+# Generated by Django 3.0.14 on 2026-10-18 15:08
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('simple_import', '0004_importlog_undoing_status'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImportedBlock',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('ranges', models.BinaryField(blank=True, default=b'')),
+                ('keys', models.TextField(blank=True)),
+                ('content_type', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='contenttypes.ContentType')),
+                ('import_log', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='simple_import.ImportLog')),
+            ],
+        ),
+    ]
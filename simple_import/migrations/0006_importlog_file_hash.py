@@ -0,0 +1,18 @@
+# Generated by Django 3.0.14 on 2026-10-18 15:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('simple_import', '0005_importedblock'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='importlog',
+            name='file_hash',
+            field=models.CharField(blank=True, editable=False, help_text='SHA-1 of import_file, the key of its parsed rows cache', max_length=40),
+        ),
+    ]
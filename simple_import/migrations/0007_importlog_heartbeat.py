@@ -0,0 +1,18 @@
+# Generated by Django 3.0.14 on 2026-10-18 15:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('simple_import', '0006_importlog_file_hash'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='importlog',
+            name='heartbeat',
+            field=models.DateTimeField(blank=True, editable=False, help_text='Last sign of life from the job running this import', null=True),
+        ),
+    ]
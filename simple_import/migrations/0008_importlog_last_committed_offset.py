@@ -0,0 +1,18 @@
+# Generated by Django 3.0.14 on 2026-10-18 15:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('simple_import', '0007_importlog_heartbeat'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='importlog',
+            name='last_committed_offset',
+            field=models.BigIntegerField(blank=True, editable=False, help_text='Byte offset in a csv import_file just past the last committed row', null=True),
+        ),
+    ]
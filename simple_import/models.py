@@ -1,15 +1,27 @@
+from contextlib import closing
+import datetime
+from itertools import chain, islice
+import json
+import logging
+from operator import itemgetter
+import struct
 from django.contrib.contenttypes.models import ContentType
 from django.conf import settings
 from django.contrib.contenttypes.fields import GenericForeignKey
 from django.core.exceptions import ValidationError
-from django.db import models, transaction
+from django.db import models, transaction, OperationalError
+from django.db.models.deletion import Collector
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+from django.utils import timezone
 from django.utils.encoding import smart_text
-from .utils import get_all_field_names
-import csv
-import datetime
-from io import StringIO
+from . import cache
+from .readers import HEADER_READERS, READERS, iter_csv_records
+from .utils import chunked, get_model_info
 AUTH_USER_MODEL = settings.AUTH_USER_MODEL
 
+logger = logging.getLogger(__name__)
+
 
 class ImportSetting(models.Model):
     """ Save some settings per user per content type """
@@ -19,6 +31,31 @@ class ImportSetting(models.Model):
     class Meta():
         unique_together = ('user', 'content_type',)
 
+    def get_column_matches(self):
+        """ Every ColumnMatch of this setting, loaded with one query """
+        return ColumnMatchIndex(self.columnmatch_set.all())
+
+
+class ColumnMatchIndex(object):
+    """ ColumnMatches by column name. find() prefers an exact match and
+    falls back to ignoring case, like the lower() comparisons the views make
+    against the header. """
+    def __init__(self, matches=()):
+        self.exact = {}
+        self.lowered = {}
+        for match in matches:
+            self.add(match)
+
+    def add(self, match):
+        self.exact[match.column_name] = match
+        self.lowered.setdefault(match.column_name.lower(), match)
+
+    def find(self, column_name):
+        match = self.exact.get(column_name)
+        if match is None:
+            match = self.lowered.get(smart_text(column_name).lower())
+        return match
+
 
 class ColumnMatch(models.Model):
     """ Match column names from the user uploaded file to the database """
@@ -41,25 +78,15 @@ class ColumnMatch(models.Model):
     def guess_field(self):
         """ Guess the match based on field names
         First look for an exact field name match
-        then search defined alternative names
-        then normalize the field name and check for match
+        then normalize the column name and look for a field name, verbose
+        name or simple_import_aliases entry that matches
+        then, with SIMPLE_IMPORT_FUZZY_MATCH, the most similar of those
         """
         model = self.import_setting.content_type.model_class()
-        field_names = get_all_field_names(model)
-        if self.column_name in field_names:
-            self.field_name = self.column_name
-            return
-        #TODO user defined alt names
-        normalized_field_name = self.column_name.lower().replace(' ', '_')
-        if normalized_field_name in field_names:
-            self.field_name = normalized_field_name
-            return
-        # Try verbose name
-        for field_name in field_names:
-            field = model._meta.get_field(field_name)
-            if hasattr(field, 'verbose_name'):
-                if (field.verbose_name.lower().replace(' ', '_') == normalized_field_name):
-                    self.field_name = field_name
+        field_name = get_model_info(model).guess_field_name(
+            self.column_name, getattr(settings, 'SIMPLE_IMPORT_FUZZY_MATCH', 0))
+        if field_name:
+            self.field_name = field_name
 
 
 class ImportLog(models.Model):
@@ -78,10 +105,83 @@ class ImportLog(models.Model):
     )
     import_type = models.CharField(max_length=1, choices=import_type_choices)
     update_key = models.CharField(max_length=200, blank=True)
+    # Progress of the last import job, see simple_import.jobs
+    status_choices = (
+        ("", "Not Started"),
+        ("queued", "Queued"),
+        ("running", "Running"),
+        ("undoing", "Undoing"),
+        ("done", "Done"),
+        ("failed", "Failed"),
+    )
+    status = models.CharField(max_length=10, choices=status_choices, blank=True, editable=False)
+    commit = models.BooleanField(default=False, blank=True, editable=False)
+    rows_done = models.IntegerField(default=0, blank=True, editable=False)
+    create_count = models.IntegerField(default=0, blank=True, editable=False)
+    update_count = models.IntegerField(default=0, blank=True, editable=False)
+    fail_count = models.IntegerField(default=0, blank=True, editable=False)
+    rows_per_second = models.FloatField(default=0, blank=True, editable=False)
+    last_committed_row = models.IntegerField(
+        default=0, blank=True, editable=False,
+        help_text="Rows committed so far when SIMPLE_IMPORT_COMMIT_CHUNK_SIZE is set")
+    last_committed_offset = models.BigIntegerField(
+        null=True, blank=True, editable=False,
+        help_text="Byte offset in a csv import_file just past the last committed row")
+    heartbeat = models.DateTimeField(
+        null=True, blank=True, editable=False,
+        help_text="Last sign of life from the job running this import")
+    file_hash = models.CharField(
+        max_length=40, blank=True, editable=False,
+        help_text="SHA-1 of import_file, the key of its parsed rows cache")
 
     def __str__(self):
         return str(self.name)
 
+    running_statuses = ("queued", "running", "undoing")
+
+    @property
+    def is_running(self):
+        return self.status in self.running_statuses
+
+    def claim(self, status, **fields):
+        """ Set status, and any other fields, unless a job is already queued
+        or running for this log. The check is part of the UPDATE, so of two
+        requests racing to start a job only one gets it. Returns whether
+        this one did. """
+        fields['heartbeat'] = timezone.now()
+        claimed = ImportLog.objects.filter(pk=self.pk).exclude(
+            status__in=self.running_statuses).update(status=status, **fields)
+        if claimed:
+            self.status = status
+            for field, value in fields.items():
+                setattr(self, field, value)
+        return bool(claimed)
+
+    def fail_if_stale(self):
+        """ Mark a queued or running job failed when it hasn't sent a
+        heartbeat for SIMPLE_IMPORT_JOB_TIMEOUT seconds, say because the
+        process running it was restarted. Otherwise is_running would keep
+        the import from being run or undone again for good. Returns whether
+        it was marked failed. """
+        timeout = getattr(settings, 'SIMPLE_IMPORT_JOB_TIMEOUT', 600)
+        if not timeout or not self.is_running:
+            return False
+        if (self.heartbeat is not None and
+                self.heartbeat > timezone.now() - datetime.timedelta(seconds=timeout)):
+            return False
+        try:
+            # Unless a heartbeat came in since we loaded the log
+            failed = ImportLog.objects.filter(
+                pk=self.pk, status=self.status, heartbeat=self.heartbeat,
+            ).update(status="failed")
+        except OperationalError:
+            # sqlite is locked by a writer, most likely the job itself with
+            # its heartbeats in a transaction we can't see yet
+            return False
+        if failed:
+            self.status = "failed"
+        return bool(failed)
+
     def clean(self):
         filename = str(self.import_file).lower()
         if not filename[-3:] in ('xls', 'ods', 'csv', 'lsx'):
@@ -90,125 +190,302 @@ class ImportLog(models.Model):
 
     @transaction.atomic
     def undo(self):
+        """ Delete the records this import created, a chunk of primary keys
+        at a time for each model """
         if self.import_type != "N":
             raise Exception("Cannot undo this type of import!")
-        for obj in self.importedobject_set.all():
-            if obj.content_object:
-                obj.content_object.delete()
-            obj.delete()
+        chunk_size = getattr(settings, 'SIMPLE_IMPORT_BATCH_SIZE', 500)
+        imported_objects = self.importedobject_set.all()
+        content_type_ids = imported_objects.values_list(
+            'content_type', flat=True).distinct().order_by()
+        for content_type_id in list(content_type_ids):
+            model_class = ContentType.objects.get_for_id(content_type_id).model_class()
+            imported = imported_objects.filter(content_type_id=content_type_id)
+            last_pk = 0
+            while True:
+                chunk = list(imported.filter(pk__gt=last_pk).order_by('pk').values_list(
+                    'pk', 'object_id')[:chunk_size])
+                if not chunk:
+                    break
+                last_pk = chunk[-1][0]
+                if model_class is not None:
+                    delete_objects(model_class._base_manager.filter(
+                        pk__in=[object_id for pk, object_id in chunk]))
+        imported_objects.delete()
+
+        for block in self.importedblock_set.all():
+            model_class = block.content_type.model_class()
+            if model_class is None:
+                continue
+            manager = model_class._base_manager
+            for first, last in block.iter_ranges():
+                # Every key in a range was imported, so it can be deleted as a range
+                for start in range(first, last + 1, chunk_size):
+                    delete_objects(manager.filter(
+                        pk__range=(start, min(start + chunk_size - 1, last))))
+            if block.keys:
+                for keys in chunked(json.loads(block.keys), chunk_size):
+                    delete_objects(manager.filter(pk__in=keys))
+        self.importedblock_set.all().delete()
+
+    def iter_imported_keys(self):
+        """ Yield (content type id, primary key) for every object this import
+        recorded, from ImportedObjects and ImportedBlocks alike """
+        yield from self.importedobject_set.values_list(
+            'content_type_id', 'object_id').order_by('pk').iterator()
+        for block in self.importedblock_set.order_by('pk'):
+            for key in block.iter_keys():
+                yield block.content_type_id, key
 
     @staticmethod
     def is_empty(value):
         """ Check `value` for emptiness by first comparing with None and then
         by coercing to string, trimming, and testing for zero length """
-        return value is None or not len(smart_text(value).strip())
+        if value is None:
+            return True
+        if isinstance(value, str):
+            return not value.strip()
+        return not len(smart_text(value).strip())
 
-    def get_matches(self):
+    def get_matches(self, header_row=None):
         """ Get each matching header row to database match
+        header_row saves reading the file again when the caller has it
+        New and moved matches are saved in bulk
         Returns a ColumnMatch queryset"""
-        header_row = self.get_import_file_as_list(only_header=True)
-        match_ids = []
+        if header_row is None:
+            header_row = self.get_header_row()
+        import_setting = self.import_setting
+        column_matches = import_setting.get_column_matches()
+        new_matches = []
+        moved_matches = {}
+        column_names = []
 
         for i, cell in enumerate(header_row):
             # Sometimes we get blank headers, ignore them.
             if self.is_empty(cell):
                 continue
 
-            try:
-                match = ColumnMatch.objects.get(
-                    import_setting=self.import_setting,
-                    column_name=cell,
-                )
-            except ColumnMatch.DoesNotExist:
+            match = column_matches.find(cell)
+            if match is None:
                 match = ColumnMatch(
-                    import_setting=self.import_setting,
+                    import_setting=import_setting,
                     column_name=cell,
                 )
                 match.guess_field()
-
+                column_matches.add(match)
+                new_matches += [match]
+            elif match.pk is not None and match.header_position != i:
+                moved_matches[match.pk] = match
             match.header_position = i
-            match.save()
+            column_names += [match.column_name]
 
-            match_ids += [match.id]
+        if new_matches:
+            ColumnMatch.objects.bulk_create(new_matches)
+        if moved_matches:
+            if hasattr(models.QuerySet, 'bulk_update'):
+                ColumnMatch.objects.bulk_update(list(moved_matches.values()), ['header_position'])
+            else:
+                # Django < 2.2
+                for match in moved_matches.values():
+                    ColumnMatch.objects.filter(pk=match.pk).update(
+                        header_position=match.header_position)
 
         return ColumnMatch.objects.filter(
-            pk__in=match_ids).order_by('header_position')
+            import_setting=import_setting,
+            column_name__in=column_names).order_by('header_position')
 
-    def get_import_file_as_list(self, only_header=False):
+    def iter_import_rows(self):
+        """ Yield the rows of the import file one at a time, header first.
+        Columns with a blank header are projected out of every row. The
+        header row is used as a unique index so it can't handle blanks.
+        Complete reads are cached on disk, see cache.py """
+        self.read_offset = None
+        cached = self.get_cached_rows()
+        if cached is not None:
+            yield from cached
+            return
+
+        spool_path = cache.get_spool_path(self)
+        if spool_path is None:
+            yield from self.parse_import_rows()
+            return
+        rows_read = 0
+        try:
+            for row in cache.read_spool(spool_path):
+                yield row
+                rows_read += 1
+            return
+        except FileNotFoundError:
+            pass
+        except Exception:
+            # Corrupt, truncated or from another version. Parse the file
+            # again, and carry on from the same row if some were read.
+            logger.warning("Import cache %s can't be read", spool_path, exc_info=True)
+            cache.remove_spool(spool_path)
+        rows = cache.write_through(self.parse_import_rows(), spool_path)
+        with closing(rows):
+            yield from islice(rows, rows_read, None)
+
+    def iter_file_records(self, start=0):
+        """ Yield (offset, row) for each row of the import file. Only csv
+        files have offsets, the byte offset just past the row, and only
+        they can be read from a start offset. Other formats yield None. """
+        file_ext = str(self.import_file).lower()[-3:]
+        if file_ext == 'csv':
+            yield from iter_csv_records(self.import_file, start)
+            return
+        self.import_file.seek(0)
+        for row in READERS[file_ext](self.import_file):
+            yield None, row
+
+    def parse_import_rows(self, start=0):
+        """ Parse the import file itself, see iter_import_rows. The offset
+        of the last row read is kept in read_offset. A csv file can be read
+        from a start offset, the header is still yielded first. """
         file_ext = str(self.import_file).lower()[-3:]
-        data = []
+        if file_ext not in READERS:
+            return
+
+        records = self.iter_file_records()
+        try:
+            offset, header_row = next(records, (None, None))
+            if header_row is None:
+                return
+            if start:
+                records.close()
+                records = self.iter_file_records(start)
+            keep_columns = tuple(
+                i for i, header_cell in enumerate(header_row)
+                if not self.is_empty(header_cell))
+            project = column_projector(keep_columns)
+            yield project(header_row)
+            width = keep_columns[-1] + 1 if keep_columns else 0
+            for offset, row in records:
+                self.read_offset = offset
+                if len(row) < width:
+                    # Short rows (csv and ods) are padded out with blanks
+                    row = list(row) + [None] * (width - len(row))
+                yield project(row)
+        finally:
+            records.close()
+
+    def open_spool(self):
+        """ The memory-mapped spool of this file's parsed rows, header
+        included, or None if the file hasn't been read in full yet. The
+        caller closes it. """
+        spool_path = cache.get_spool_path(self)
+        if spool_path is None:
+            return None
+        try:
+            return cache.Spool(spool_path)
+        except FileNotFoundError:
+            return None
+        except Exception:
+            logger.warning("Import cache %s can't be read", spool_path, exc_info=True)
+            cache.remove_spool(spool_path)
+            return None
+
+    def delete_spool(self):
+        """ Remove the cached parsed rows of the import file. Only files
+        that have been hashed can have been cached. """
+        if not self.file_hash:
+            return
+        spool_path = cache.get_spool_path(self)
+        if spool_path is not None:
+            cache.remove_spool(spool_path)
+
+    def get_file_hash(self):
+        """ Hash of the import file's content. start_import saves it with the
+        upload, other logs hash their file once on first use. """
+        if not self.file_hash:
+            self.file_hash = cache.get_file_hash(self.import_file)
+            if self.pk is not None:
+                ImportLog.objects.filter(pk=self.pk).update(file_hash=self.file_hash)
+        return self.file_hash
+
+    def get_cached_rows(self):
+        """ Rows parsed by an earlier get_import_file_as_list on this
+        instance, if the file hasn't changed since """
+        cached = getattr(self, '_parsed_rows', None)
+        if cached is not None and cached[0] == str(self.import_file):
+            return cached[1]
+        return None
+
+    def get_header_row(self):
+        """ Read only the header row, with blank header cells removed.
+        Each format has a probe that stops after the first row, so this costs
+        about the same for any file size. """
+        cached = self.get_cached_rows()
+        if cached is not None:
+            return list(cached[0]) if cached else []
+
+        file_ext = str(self.import_file).lower()[-3:]
+        reader = HEADER_READERS.get(file_ext)
+        if reader is None:
+            return []
 
         self.import_file.seek(0)
+        return [
+            header_cell for header_cell in reader(self.import_file)
+            if not self.is_empty(header_cell)]
 
-        if file_ext == "xls":
-            import xlrd
-
-            wb = xlrd.open_workbook(file_contents=self.import_file.read())
-            sh1 = wb.sheet_by_index(0)
-            for rownum in range(sh1.nrows):
-                row_values = []
-                for cell in sh1.row(rownum):
-                    # xlrd is too dumb to just check for dates. So we have to ourselves
-                    # 3 is date
-                    # http://www.lexicon.net/sjmachin/xlrd.html#xlrd.Cell-class
-                    if cell.ctype == 3:
-                        row_values += [datetime.datetime(*xlrd.xldate_as_tuple(cell.value, wb.datemode))]
-                    else:
-                        row_values += [cell.value]
-                data += [row_values]
-                if only_header:
-                    break
-        elif file_ext == "csv":
-            reader = csv.reader(StringIO(self.import_file.read().decode()))
-            for row in reader:
-                data += [row]
-                if only_header:
-                    break
-        elif file_ext == "lsx":
-            from openpyxl.reader.excel import load_workbook
-            # load_workbook actually accepts a file-like object for the filename param
-            wb = load_workbook(filename=self.import_file, read_only=True)
-            sheet = wb.get_active_sheet()
-            for row in sheet.iter_rows():
-                data_row = []
-                for cell in row:
-                    data_row += [cell.value]
-                data += [data_row]
-                if only_header:
-                    break
-        elif file_ext == "ods":
-            from .odsreader import ODSReader
-            doc = ODSReader(self.import_file)
-            table = list(doc.SHEETS.items())[0]
-
-            # Remove blank columns that ods files seems to have
-            blank_columns = []
-            for i, header_cell in enumerate(table[1][0]):
-                if self.is_empty(header_cell):
-                    blank_columns += [i]
-            # just an overly complicated way to remove these
-            # indexes from a list
-            for offset, blank_column in enumerate(blank_columns):
-                for row in table[1]:
-                    del row[blank_column - offset]
-
-            if only_header:
-                data += [table[1][0]]
-            else:
-                data += table[1]
-        # Remove blank columns. We use the header row as a unique index. Can't handle blanks.
-        columns_to_del = []
-        for i, header_cell in enumerate(data[0]):
-            if self.is_empty(header_cell):
-                columns_to_del += [i]
-        num_deleted = 0
-        for column_to_del in columns_to_del:
-            for row in data:
-                del row[column_to_del - num_deleted]
-            num_deleted += 1
+    def get_import_file_as_list(self, only_header=False):
+        """ The whole projected file as a list. It's parsed once per
+        instance, later calls and iter_import_rows reuse the result. """
         if only_header:
-            return data[0]
-        return data
+            return self.get_header_row()
+        rows = self.get_cached_rows()
+        if rows is None:
+            with closing(self.iter_import_rows()) as import_rows:
+                rows = list(import_rows)
+            self._parsed_rows = (str(self.import_file), rows)
+        return rows
+
+    def get_error_preview(self, count):
+        """ The header and first count rows of the error file """
+        reader = READERS.get(str(self.error_file).lower()[-3:])
+        if not self.error_file or reader is None:
+            return []
+        self.error_file.open('rb')
+        try:
+            with closing(reader(self.error_file)) as rows:
+                return list(islice(rows, count + 1))
+        finally:
+            self.error_file.close()
+
+
+@receiver(post_delete, sender=ImportLog)
+def delete_import_log_spool(sender, instance, **kwargs):
+    """ Cached rows are stored next to the upload or in the cache dir, and
+    nothing else would remove them """
+    instance.delete_spool()
+
+
+def delete_objects(queryset):
+    """ Delete a queryset with a single DELETE when nothing else needs to
+    know (no signals, cascades or custom delete()), otherwise let the
+    Collector handle it. """
+    model_class = queryset.model
+    if model_class.delete is not models.Model.delete:
+        for obj in queryset:
+            obj.delete()
+        return
+    collector = Collector(using=queryset.db)
+    if collector.can_fast_delete(queryset):
+        queryset._raw_delete(queryset.db)
+    else:
+        queryset.delete()
+
+
+def column_projector(keep_columns):
+    """ A function picking keep_columns out of a row in one pass. """
+    if not keep_columns:
+        return lambda row: []
+    if len(keep_columns) == 1:
+        index = keep_columns[0]
+        return lambda row: [row[index]]
+    getter = itemgetter(*keep_columns)
+    return lambda row: list(getter(row))
 
 
 class RelationalMatch(models.Model):
@@ -230,3 +507,47 @@ class ImportedObject(models.Model):
     object_id = models.IntegerField()
     content_type = models.ForeignKey(ContentType, on_delete=models.CASCADE)
     content_object = GenericForeignKey('content_type', 'object_id')
+
+
+class ImportedBlock(models.Model):
+    """ The primary keys of a batch of imported objects in one row, used
+    instead of an ImportedObject per object with SIMPLE_IMPORT_COMPACT_TRACKING
+    and for keys ImportedObject can't hold (uuid, bigint, text).
+    Integer keys are stored as (first, last) ranges packed as 8 byte
+    integers, so the sequential ids of a bulk insert take 16 bytes.
+    Other keys are stored as a json list. """
+    import_log = models.ForeignKey(ImportLog, on_delete=models.CASCADE)
+    content_type = models.ForeignKey(ContentType, on_delete=models.CASCADE)
+    ranges = models.BinaryField(blank=True, default=b'')
+    keys = models.TextField(blank=True)
+
+    @classmethod
+    def from_keys(cls, import_log, content_type, keys):
+        integer_keys = sorted(set(key for key in keys if type(key) is int))
+        ranges = []
+        for key in integer_keys:
+            if ranges and ranges[-1][1] == key - 1:
+                ranges[-1][1] = key
+            else:
+                ranges += [[key, key]]
+        other_keys = [str(key) for key in keys if type(key) is not int]
+        return cls(
+            import_log=import_log,
+            content_type=content_type,
+            ranges=struct.pack('<%dq' % (len(ranges) * 2), *chain.from_iterable(ranges)),
+            keys=json.dumps(other_keys) if other_keys else '',
+        )
+
+    def iter_ranges(self):
+        values = struct.unpack('<%dq' % (len(self.ranges) // 8), bytes(self.ranges))
+        return zip(values[::2], values[1::2])
+
+    def iter_keys(self):
+        for first, last in self.iter_ranges():
+            yield from range(first, last + 1)
+        if self.keys:
+            yield from json.loads(self.keys)
+
+    def count_keys(self):
+        count = sum(last - first + 1 for first, last in self.iter_ranges())
+        return count + (len(json.loads(self.keys)) if self.keys else 0)
@@ -14,65 +14,152 @@
 
 # Thanks to grt for the fixes
 
-import odf.opendocument
-from odf.table import *
-from odf.text import P
+""" Streaming reader for OpenDocument spreadsheets.
+content.xml is parsed incrementally out of the zip and each row is thrown
+away once it's been yielded, so memory doesn't grow with the document.
+Like the original DOM based reader, cells hold their text, repeated cells
+are expanded, cells starting with # are treated as comments and skipped,
+and rows without cells are skipped.
+"""
+import zipfile
+from xml.etree import ElementTree
+
+TABLE_NS = '{urn:oasis:names:tc:opendocument:xmlns:table:1.0}'
+TEXT_NS = '{urn:oasis:names:tc:opendocument:xmlns:text:1.0}'
+
+TABLE = TABLE_NS + 'table'
+TABLE_ROW = TABLE_NS + 'table-row'
+TABLE_CELL = TABLE_NS + 'table-cell'
+ROWS_REPEATED = TABLE_NS + 'number-rows-repeated'
+COLUMNS_REPEATED = TABLE_NS + 'number-columns-repeated'
+P = TEXT_NS + 'p'
+SPACE = TEXT_NS + 's'
+TAB = TEXT_NS + 'tab'
+LINE_BREAK = TEXT_NS + 'line-break'
+
+
+def element_text(element):
+    """ Text of a paragraph, with the spaces, tabs and line breaks that ODF
+    stores as elements put back """
+    parts = [element.text or '']
+    for child in element:
+        if child.tag == SPACE:
+            parts += [' ' * int(child.get(TEXT_NS + 'c', 1))]
+        elif child.tag == TAB:
+            parts += ['\t']
+        elif child.tag == LINE_BREAK:
+            parts += ['\n']
+        else:
+            parts += [element_text(child)]
+        parts += [child.tail or '']
+    return ''.join(parts)
+
+
+def cell_text(cell):
+    # Direct children only, annotations have paragraphs of their own
+    return '\n'.join(element_text(p) for p in cell.findall(P))
+
+
+def row_cells(row, width=None):
+    """ Expand a table-row element into a list of cell text. Runs of
+    repeated cells are capped at width, and trailing empty cells (often
+    repeated to the last column of the sheet) are only kept up to width. """
+    cells = []
+    pending_empty = 0
+    for cell in row.findall(TABLE_CELL):
+        text = cell_text(cell)
+        if text and text[0] == '#':
+            # ignore comments cells
+            continue
+        repeat = int(cell.get(COLUMNS_REPEATED, 1))
+        if not text:
+            pending_empty += repeat
+            continue
+        if pending_empty:
+            cells += [''] * pending_empty
+            pending_empty = 0
+        if width is not None:
+            repeat = max(min(repeat, width - len(cells)), 1)
+        cells += [text] * repeat
+    if width is not None:
+        cells += [''] * min(pending_empty, max(width - len(cells), 0))
+    elif pending_empty and not cells:
+        # A row of only empty cells still counts as a row
+        cells = ['']
+    return cells
+
+
+def iter_sheet_rows(file, sheet_index=0):
+    """ Yield the rows of one sheet as lists of cell text. Parsing stops at
+    the end of that sheet. Every row after the first is capped at the width
+    of the first row, and trailing empty rows are dropped. """
+    with zipfile.ZipFile(file) as archive:
+        with archive.open('content.xml') as content:
+            sheet = -1
+            parents = []
+            width = None
+            pending_empty_rows = []
+            for event, element in ElementTree.iterparse(content, events=('start', 'end')):
+                if event == 'start':
+                    if element.tag == TABLE:
+                        sheet += 1
+                    parents += [element]
+                    continue
+                parents.pop()
+                if element.tag == TABLE and sheet == sheet_index:
+                    return
+                if element.tag != TABLE_ROW or sheet != sheet_index:
+                    continue
+
+                cells = row_cells(element, width)
+                repeat = int(element.get(ROWS_REPEATED, 1))
+                # Done with the row, drop it so the tree doesn't keep growing
+                if parents:
+                    parents[-1].remove(element)
+                if not cells:
+                    continue
+                if width is None:
+                    while cells and not cells[-1]:
+                        cells.pop()
+                    width = len(cells)
+                if not any(cells):
+                    # Only kept if a row with data follows
+                    pending_empty_rows += [(cells, repeat)]
+                    continue
+                for empty_cells, empty_repeat in pending_empty_rows:
+                    for i in range(empty_repeat):
+                        yield list(empty_cells)
+                pending_empty_rows = []
+                for i in range(repeat):
+                    yield list(cells)
+
+
+def read_header(file, sheet_index=0):
+    rows = iter_sheet_rows(file, sheet_index)
+    try:
+        return next(rows, [])
+    finally:
+        rows.close()
+
 
 class ODSReader:
+    """ Every sheet by name, as an array (rows) of arrays (columns).
+    Kept for backwards compatibility, this holds the whole document in
+    memory so prefer iter_sheet_rows. """
+
+    # loads the file
+    def __init__(self, file):
+        self.SHEETS = {}
+        with zipfile.ZipFile(file) as archive:
+            with archive.open('content.xml') as content:
+                names = [
+                    element.get(TABLE_NS + 'name')
+                    for event, element in ElementTree.iterparse(content, events=('start',))
+                    if element.tag == TABLE]
+        for i, name in enumerate(names):
+            file.seek(0)
+            self.SHEETS[name] = list(iter_sheet_rows(file, i))
 
-	# loads the file
-	def __init__(self, file):
-		self.doc = odf.opendocument.load(file)
-		self.SHEETS = {}
-		for sheet in self.doc.spreadsheet.getElementsByType(Table):
-			self.readSheet(sheet)
-	
-
-	# reads a sheet in the sheet dictionary, storing each sheet as an array (rows) of arrays (columns)
-	def readSheet(self, sheet):
-		name = sheet.getAttribute("name")
-		rows = sheet.getElementsByType(TableRow)
-		arrRows = []
-		
-		# for each row
-		for row in rows:
-			row_comment = ""
-			arrCells = []
-			cells = row.getElementsByType(TableCell)
-			
-			# for each cell
-			for cell in cells:
-				# repeated value?
-				repeat = cell.getAttribute("numbercolumnsrepeated")
-				if(not repeat):
-					repeat = 1
-					
-				ps = cell.getElementsByType(P)
-				textContent = ""
-								
-				# for each text node
-				for p in ps:
-					for n in p.childNodes:
-						if (n.nodeType == 3):
-							textContent = textContent + str(n.data)
-					
-				if(textContent or textContent == ""):
-					if(textContent == "" or textContent[0] != "#"): # ignore comments cells
-						for rr in range(int(repeat)): # repeated?
-							arrCells.append(textContent)
-						
-					else:
-						row_comment = row_comment + textContent + " ";
-						
-			# if row contained something
-			if(len(arrCells)):
-				arrRows.append(arrCells)
-				
-			#else:
-			#	print "Empty or commented row (", row_comment, ")"
-		
-		self.SHEETS[name] = arrRows
-		
-	# returns a sheet as an array (rows) of arrays (columns)
-	def getSheet(self, name):
-		return self.SHEETS[name]
\ No newline at end of file
+    # returns a sheet as an array (rows) of arrays (columns)
+    def getSheet(self, name):
+        return self.SHEETS[name]
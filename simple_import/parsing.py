@@ -0,0 +1,166 @@
+""" Typed column parsing
+With SIMPLE_IMPORT_TYPED_PARSING on, cells matched to integer, decimal,
+float, date, datetime and boolean fields are converted to the field's type a
+chunk of rows at a time, one column at a time, before any model object is
+built. Integer and float columns are converted with a single NumPy call when
+NumPy is installed. Everything else, and any column NumPy can't convert in
+one go, or whose text the field wouldn't take, goes through the field's
+to_python() cell by cell, which also finds the exact cells that fail. A row
+with a cell that doesn't convert fails with a ParseError naming the column
+and the type that was expected.
+"""
+import re
+
+from django.core.exceptions import ValidationError
+from django.db import models
+
+BOOLEAN_STRINGS = {
+    'false': False, 'f': False, 'no': False, 'n': False, '0': False, 'off': False,
+    'true': True, 't': True, 'yes': True, 'y': True, '1': True, 'on': True,
+}
+
+INTEGER = 'Integer'
+DECIMAL = 'Decimal'
+FLOAT = 'Float'
+DATE = 'Date'
+DATETIME = 'DateTime'
+BOOLEAN = 'Boolean'
+
+# float64 holds every integer up to this exactly
+MAX_EXACT_FLOAT_INTEGER = 2 ** 53
+
+# Text IntegerField.to_python takes, and NumPy converts to the same number.
+# NumPy would also take '1e3' or '12.0', which int() refuses.
+INTEGER_STRING = re.compile(r'\s*[+-]?[0-9]+\s*\Z')
+
+
+def get_numpy():
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
+
+def get_parse_type(field):
+    """ The type name a field's cells are parsed as, or None when they are
+    left for the field to convert on save """
+    # DateTimeField is a DateField and AutoField an IntegerField
+    if isinstance(field, models.DateTimeField):
+        return DATETIME
+    if isinstance(field, models.DateField):
+        return DATE
+    if isinstance(field, models.BooleanField):
+        return BOOLEAN
+    if isinstance(field, models.IntegerField):
+        return INTEGER
+    if isinstance(field, models.DecimalField):
+        return DECIMAL
+    if isinstance(field, models.FloatField):
+        return FLOAT
+    return None
+
+
+class ParseError(ValidationError):
+    """ A cell that couldn't be converted to its column's type """
+    def __init__(self, column_name, type_name, value, exc):
+        self.column_name = column_name
+        self.type_name = type_name
+        self.value = value
+        if isinstance(exc, ValidationError):
+            reasons = exc.messages
+        else:
+            reasons = [str(exc)]
+        super(ParseError, self).__init__([
+            u"{0}: {1}".format(column_name, reason) for reason in reasons])
+
+
+class ColumnParser(object):
+    """ Converts the cells of one column to its field's type """
+    def __init__(self, index, column_name, field, type_name, is_empty):
+        self.index = index
+        self.column_name = column_name
+        self.field = field
+        self.type_name = type_name
+        self.is_empty = is_empty
+
+    def to_python(self, value):
+        field = self.field
+        if self.type_name == BOOLEAN and isinstance(value, str):
+            value = BOOLEAN_STRINGS.get(value.strip().lower(), value)
+        elif self.type_name == INTEGER and isinstance(value, float):
+            # int() would quietly drop the fraction
+            if not value.is_integer():
+                raise ValidationError(
+                    field.error_messages['invalid'], code='invalid', params={'value': value})
+            value = int(value)
+        elif isinstance(value, str) and self.type_name != DECIMAL:
+            value = value.strip()
+        return field.to_python(value)
+
+    def convert_batch(self, values):
+        """ Convert every value with one NumPy call. Returns None when NumPy
+        isn't installed or any value fails, so the caller can fall back to
+        converting cell by cell. """
+        if self.type_name not in (INTEGER, FLOAT):
+            return None
+        if self.type_name == INTEGER and not all(
+                INTEGER_STRING.match(value) for value in values if isinstance(value, str)):
+            return None
+        numpy = get_numpy()
+        if numpy is None:
+            return None
+        try:
+            array = numpy.array(values, dtype=numpy.float64)
+        except (TypeError, ValueError, OverflowError):
+            return None
+        if self.type_name == FLOAT:
+            return array.tolist()
+        if not ((array == numpy.floor(array)).all() and
+                (numpy.abs(array) < MAX_EXACT_FLOAT_INTEGER).all()):
+            # Fractions, nan, or too big to go through a float exactly
+            return None
+        return array.astype(numpy.int64).tolist()
+
+    def parse(self, rows):
+        """ Convert this column's cells in rows, in place. Blank cells are
+        left alone for the column's default or null handling. Returns
+        {row position: ParseError} for the cells that failed. """
+        index = self.index
+        positions = []
+        values = []
+        for position, row in enumerate(rows):
+            if index < len(row) and not self.is_empty(row[index]):
+                positions += [position]
+                values += [row[index]]
+        errors = {}
+        if not values:
+            return errors
+        converted = self.convert_batch(values)
+        if converted is not None:
+            for position, value in zip(positions, converted):
+                rows[position][index] = value
+            return errors
+        for position, value in zip(positions, values):
+            try:
+                rows[position][index] = self.to_python(value)
+            except (ValidationError, TypeError, ValueError, OverflowError) as exc:
+                errors[position] = ParseError(self.column_name, self.type_name, value, exc)
+        return errors
+
+
+def parse_chunk(parsers, rows):
+    """ Convert the typed columns of a chunk of rows. Returns the converted
+    rows that parsed and a list of (row, ParseError) for the rows that
+    didn't, with the row as it was read. Only the first bad cell of a row
+    is reported. """
+    parsed_rows = [list(row) for row in rows]
+    errors = {}
+    for parser in parsers:
+        for position, exc in parser.parse(parsed_rows).items():
+            errors.setdefault(position, exc)
+    if not errors:
+        return parsed_rows, []
+    return (
+        [row for position, row in enumerate(parsed_rows) if position not in errors],
+        [(rows[position], errors[position]) for position in sorted(errors)])
@@ -0,0 +1,262 @@
+""" Streaming readers for the supported import file formats
+Each reader takes a file like object and yields rows as lists of cell values
+without holding the whole sheet in memory.
+"""
+import codecs
+import csv
+import datetime
+import io
+import os
+
+
+CSV_SAMPLE_SIZE = 64 * 1024
+CSV_DELIMITERS = ',;\t|'
+# utf-32 first, its little endian BOM starts with utf-16's
+CSV_BOMS = (
+    (codecs.BOM_UTF32_LE, 'utf-32'),
+    (codecs.BOM_UTF32_BE, 'utf-32'),
+    (codecs.BOM_UTF8, 'utf-8-sig'),
+    (codecs.BOM_UTF16_LE, 'utf-16'),
+    (codecs.BOM_UTF16_BE, 'utf-16'),
+)
+# Encodings where a newline is always the byte \n, so lines can be split
+# before decoding and offsets counted in bytes
+CSV_LINE_ENCODINGS = ('utf-8', 'utf-8-sig', 'cp1252', 'latin-1')
+
+
+def detect_csv_encoding(sample):
+    """ Pick an encoding from a BOM, or the first of utf-8 and cp1252 that
+    can decode the sample. latin-1 decodes anything. """
+    for bom, encoding in CSV_BOMS:
+        if sample.startswith(bom):
+            return encoding
+    for encoding in ('utf-8', 'cp1252'):
+        try:
+            # Not final, the sample may end part way through a character
+            codecs.getincrementaldecoder(encoding)().decode(sample, final=False)
+        except UnicodeDecodeError:
+            continue
+        return encoding
+    return 'latin-1'
+
+
+def sniff_csv_delimiter(text):
+    """ Only the delimiter is taken from csv.Sniffer, its quoting guesses
+    are unreliable on samples without quotes """
+    last_line_end = text.rfind('\n')
+    if last_line_end != -1:
+        text = text[:last_line_end + 1]
+    try:
+        return csv.Sniffer().sniff(text, delimiters=CSV_DELIMITERS).delimiter
+    except csv.Error:
+        return ','
+
+
+def iter_binary_lines(binary_file, block_size=CSV_SAMPLE_SIZE):
+    """ Lines of a binary file, a block at a time """
+    pending = b''
+    while True:
+        block = binary_file.read(block_size)
+        if not block:
+            break
+        lines = (pending + block).splitlines(True)
+        # The last line may be incomplete, or a \r missing its \n
+        pending = lines.pop()
+        yield from lines
+    if pending:
+        yield pending
+
+
+def iter_csv_records(import_file, start=0):
+    """ Yield (offset, row) for each record of a csv file, where offset is
+    the byte offset just past the record. Passing a returned offset as
+    start continues reading after that record. The file is decoded as it
+    is read, so memory use doesn't depend on its size. Offsets are None
+    for utf-16 and utf-32 files, which are read from the start. """
+    import_file.seek(0)
+    sample = import_file.read(CSV_SAMPLE_SIZE)
+    encoding = detect_csv_encoding(sample)
+    sample_text = codecs.getincrementaldecoder(encoding)(errors='replace').decode(sample)
+    delimiter = sniff_csv_delimiter(sample_text)
+
+    if encoding not in CSV_LINE_ENCODINGS:
+        import_file.seek(0)
+        text_file = io.TextIOWrapper(import_file, encoding=encoding, newline='')
+        try:
+            for row in csv.reader(text_file, delimiter=delimiter):
+                yield None, row
+        finally:
+            # Don't let the wrapper close the underlying upload
+            text_file.detach()
+        return
+
+    import_file.seek(start)
+    if start:
+        # A BOM was skipped with the first record
+        encoding = 'utf-8' if encoding == 'utf-8-sig' else encoding
+    decode = codecs.getincrementaldecoder(encoding)().decode
+    position = [start]
+
+    def lines():
+        for line in iter_binary_lines(import_file):
+            position[0] += len(line)
+            yield decode(line)
+
+    for row in csv.reader(lines(), delimiter=delimiter):
+        yield position[0], row
+
+
+def iter_csv_rows(import_file):
+    for offset, row in iter_csv_records(import_file):
+        yield row
+
+
+def read_csv_header(import_file):
+    """ Decode just enough of the upload to parse the first record """
+    rows = iter_csv_rows(import_file)
+    try:
+        return next(rows, [])
+    finally:
+        rows.close()
+
+
+XLS_BLOCK_SIZE = 1000
+# Day 0 of each datemode. The 1900 system counts a 29 February 1900 that
+# never happened, so adding days to the epoch is only right from day 61.
+XLS_EPOCHS = (datetime.datetime(1899, 12, 30), datetime.datetime(1904, 1, 1))
+XLS_FIRST_DAYS = (61, 1)
+XLS_DAYS_TOO_LARGE = (2958466, 2958466 - 1462)
+
+
+def _xldate_as_datetime(value, datemode):
+    import xlrd
+    return datetime.datetime(*xlrd.xldate_as_tuple(value, datemode))
+
+
+def convert_xls_dates(values, datemode):
+    """ Convert a column of Excel date numbers to datetimes in one go, by
+    adding them to the epoch. Times without a date, the first days of 1900
+    and anything out of range go through xlrd's xldate_as_tuple instead, so
+    they're handled (or fail) exactly like before. """
+    epoch = XLS_EPOCHS[datemode]
+    first_day = XLS_FIRST_DAYS[datemode]
+    # Rounding to the second may still add a day
+    last_day = XLS_DAYS_TOO_LARGE[datemode] - 2
+    timedelta = datetime.timedelta
+    dates = []
+    for value in values:
+        days = int(value)
+        if first_day <= days <= last_day:
+            # To the nearest second, like xldate_as_tuple
+            dates += [epoch + timedelta(days=days, seconds=int(round((value - days) * 86400.0)))]
+        else:
+            dates += [_xldate_as_datetime(value, datemode)]
+    return dates
+
+
+def _open_xls(import_file):
+    import xlrd
+    from .cache import get_local_path
+    # on_demand keeps xlrd from parsing every sheet when we only use the
+    # first. A file on disk is memory-mapped rather than read into memory.
+    path = get_local_path(import_file)
+    if path is not None and os.path.exists(path):
+        return xlrd.open_workbook(path, on_demand=True)
+    return xlrd.open_workbook(file_contents=import_file.read(), on_demand=True)
+
+
+def _iter_xls_sheet_rows(wb, sheet, start=0, stop=None):
+    """ Yield rows start up to stop. Each block of XLS_BLOCK_SIZE rows is
+    read a column at a time, with the date cells of a column converted
+    together, then turned into rows. """
+    import xlrd
+
+    if stop is None or stop > sheet.nrows:
+        stop = sheet.nrows
+    for block_start in range(start, stop, XLS_BLOCK_SIZE):
+        block_end = min(block_start + XLS_BLOCK_SIZE, stop)
+        columns = []
+        for colx in range(sheet.ncols):
+            values = sheet.col_values(colx, block_start, block_end)
+            # xlrd only reports a date as a number with a date format, so
+            # we convert them ourselves
+            date_rows = [
+                i for i, ctype in enumerate(sheet.col_types(colx, block_start, block_end))
+                if ctype == xlrd.XL_CELL_DATE]
+            if date_rows:
+                dates = convert_xls_dates([values[i] for i in date_rows], wb.datemode)
+                for i, date in zip(date_rows, dates):
+                    values[i] = date
+            columns += [values]
+        if not columns:
+            for rownum in range(block_start, block_end):
+                yield []
+            continue
+        for row in zip(*columns):
+            yield list(row)
+
+
+def iter_xls_rows(import_file):
+    wb = _open_xls(import_file)
+    try:
+        yield from _iter_xls_sheet_rows(wb, wb.sheet_by_index(0))
+    finally:
+        wb.release_resources()
+
+
+def read_xls_header(import_file):
+    """ xlrd can't stop part way through a sheet, so this still parses
+    sheet 0, but no other sheet and only the first row is converted """
+    wb = _open_xls(import_file)
+    try:
+        return next(_iter_xls_sheet_rows(wb, wb.sheet_by_index(0), stop=1), [])
+    finally:
+        wb.release_resources()
+
+
+def iter_xlsx_rows(import_file):
+    from openpyxl.reader.excel import load_workbook
+    # load_workbook actually accepts a file-like object for the filename param
+    wb = load_workbook(filename=import_file, read_only=True)
+    try:
+        for row in wb.active.iter_rows(values_only=True):
+            yield list(row)
+    finally:
+        wb.close()
+
+
+def read_xlsx_header(import_file):
+    from openpyxl.reader.excel import load_workbook
+    wb = load_workbook(filename=import_file, read_only=True)
+    try:
+        for row in wb.active.iter_rows(max_row=1, values_only=True):
+            return list(row)
+        return []
+    finally:
+        wb.close()
+
+
+def iter_ods_rows(import_file):
+    from .odsreader import iter_sheet_rows
+    # Only the first sheet is imported
+    return iter_sheet_rows(import_file)
+
+
+def read_ods_header(import_file):
+    from .odsreader import read_header
+    return read_header(import_file)
+
+
+READERS = {
+    'csv': iter_csv_rows,
+    'xls': iter_xls_rows,
+    'lsx': iter_xlsx_rows,
+    'ods': iter_ods_rows,
+}
+
+HEADER_READERS = {
+    'csv': read_csv_header,
+    'xls': read_xls_header,
+    'lsx': read_xlsx_header,
+    'ods': read_ods_header,
+}
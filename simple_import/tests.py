@@ -1,14 +1,56 @@
+import csv
+import datetime
+import hashlib
+import io
 import os
+import tempfile
+import zipfile
+from contextlib import closing, contextmanager
+from itertools import islice
+from unittest import mock, skipUnless
 
 from django.contrib.contenttypes.models import ContentType
 from django.urls import reverse
-from django.test import TestCase
+from django.db import IntegrityError, connection
+from django.db.models import Q, QuerySet
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from . import cache
+from .importer import ImportColumn, Importer, RelatedKeyIndex, import_partition
 from .models import *
+from .odsreader import ODSReader, iter_sheet_rows, read_header
+from .parsing import BOOLEAN, DATE, DECIMAL, FLOAT, INTEGER, ColumnParser, get_numpy, parse_chunk
+from . import readers
+from .readers import READERS, convert_xls_dates, iter_csv_records, iter_csv_rows
 from django.core.files import File
+from django.core.files.base import ContentFile
 from django.contrib.auth import get_user_model
 User = get_user_model()
 
 
+@contextmanager
+def case_insensitive(model, field_name):
+    """ Look up model's field_name like a case insensitive collation (MySQL's
+    default) would. sqlite compares text exactly. """
+    real_filter = QuerySet.filter
+
+    def filter(queryset, *args, **kwargs):
+        if queryset.model is model:
+            if field_name in kwargs:
+                kwargs[field_name + '__iexact'] = kwargs.pop(field_name)
+            if field_name + '__in' in kwargs:
+                values = Q(pk__in=[])
+                for value in kwargs.pop(field_name + '__in'):
+                    values |= Q(**{field_name + '__iexact': value})
+                args += (values,)
+        return real_filter(queryset, *args, **kwargs)
+
+    with mock.patch.object(QuerySet, 'filter', filter):
+        yield
+
+
+@override_settings(SIMPLE_IMPORT_JOB_RUNNER='simple_import.jobs.ImmediateRunner')
 class SimpleTest(TestCase):
     def setUp(self):
         user = User.objects.create_user(
@@ -32,6 +74,24 @@ class SimpleTest(TestCase):
                 import_setting=self.import_setting,
                 import_type='N',
             )
+
+    def create_import_log(self, model, data, columns=('name',), import_type='N', **kwargs):
+        """ An import of csv data into model, with each column matched to
+        the field of the same name """
+        import_setting, created = ImportSetting.objects.get_or_create(
+            user=self.user, content_type=ContentType.objects.get_for_model(model))
+        for i, name in enumerate(columns):
+            ColumnMatch.objects.get_or_create(
+                column_name=name, field_name=name,
+                import_setting=import_setting, header_position=i)
+        return ImportLog.objects.create(
+            name="test",
+            user=self.user,
+            import_file=ContentFile(data, name="import.csv"),
+            import_setting=import_setting,
+            import_type=import_type,
+            **kwargs
+        )
     
     def test_csv(self):
         path = os.path.join(
@@ -61,13 +121,886 @@ class SimpleTest(TestCase):
         file_data = import_log.get_import_file_as_list(only_header=True)
         self.assertIn('name', file_data)
 
+    def test_header_probe(self):
+        """ Reading the header should not decode the whole csv """
+        body = b"name,,user\n" + b"foo,bar,1\n" * 100000
+        import_log = ImportLog.objects.create(
+            name="test",
+            user=self.user,
+            import_file=ContentFile(body, name="big.csv"),
+            import_setting=self.import_setting,
+            import_type='N',
+        )
+        self.assertEqual(import_log.get_header_row(), ['name', 'user'])
+        self.assertLess(import_log.import_file.tell(), len(body) // 10)
+
+        with open(os.path.join(os.path.dirname(__file__), 'static', 'test_import.ods'), 'rb') as fp:
+            ods_log = ImportLog.objects.create(
+                name="test",
+                user=self.user,
+                import_file=File(fp),
+                import_setting=self.import_setting,
+                import_type='N',
+            )
+        self.assertEqual(
+            ods_log.get_header_row(), ods_log.get_import_file_as_list()[0])
+
+    def test_iter_import_rows(self):
+        import_log = ImportLog.objects.create(
+            name="test",
+            user=self.user,
+            import_file=ContentFile(b"name,,user\nfoo,skip,1\nbar\n", name="rows.csv"),
+            import_setting=self.import_setting,
+            import_type='N',
+        )
+        rows = import_log.iter_import_rows()
+        self.assertEqual(next(rows), ['name', 'user'])
+        self.assertEqual(list(rows), [['foo', '1'], ['bar', None]])
+
+    def test_import_file_parsed_once(self):
+        import_log = ImportLog.objects.create(
+            name="test",
+            user=self.user,
+            import_file=ContentFile(b"name,,user\nfoo,skip,1\n", name="rows.csv"),
+            import_setting=self.import_setting,
+            import_type='N',
+        )
+        rows = import_log.get_import_file_as_list()
+        self.assertEqual(rows, [['name', 'user'], ['foo', '1']])
+        import_log.import_file.close()
+        # Served from the parsed rows, the closed file isn't touched again
+        self.assertEqual(list(import_log.iter_import_rows()), rows)
+        self.assertEqual(import_log.get_header_row(), ['name', 'user'])
+        self.assertEqual(column_projector((0, 2))(['a', 'b', 'c']), ['a', 'c'])
+        self.assertEqual(column_projector((1,))(['a', 'b']), ['b'])
+        self.assertEqual(column_projector(())(['a']), [])
+
+    def test_ods_stream(self):
+        """ Sheets padded out to the last row and column shouldn't be expanded """
+        content = (
+            '<office:document-content'
+            ' xmlns:office="urn:oasis:names:tc:opendocument:xmlns:office:1.0"'
+            ' xmlns:table="urn:oasis:names:tc:opendocument:xmlns:table:1.0"'
+            ' xmlns:text="urn:oasis:names:tc:opendocument:xmlns:text:1.0">'
+            '<office:body><office:spreadsheet><table:table table:name="one">'
+            '<table:table-row><table:table-cell><text:p>name</text:p></table:table-cell>'
+            '<table:table-cell><text:p>a<text:s text:c="2"/>b</text:p></table:table-cell>'
+            '<table:table-cell table:number-columns-repeated="16382"/></table:table-row>'
+            '<table:table-row><table:table-cell table:number-columns-repeated="2">'
+            '<text:p>x</text:p></table:table-cell>'
+            '<table:table-cell table:number-columns-repeated="16382"/></table:table-row>'
+            '<table:table-row table:number-rows-repeated="2">'
+            '<table:table-cell table:number-columns-repeated="16384"/></table:table-row>'
+            '<table:table-row><table:table-cell table:number-columns-repeated="16384">'
+            '<text:p>y</text:p></table:table-cell></table:table-row>'
+            '<table:table-row table:number-rows-repeated="1048570">'
+            '<table:table-cell table:number-columns-repeated="16384"/></table:table-row>'
+            '</table:table><table:table table:name="two">'
+            '<table:table-row><table:table-cell><text:p>other</text:p></table:table-cell>'
+            '</table:table-row></table:table></office:spreadsheet></office:body>'
+            '</office:document-content>')
+        buf = io.BytesIO()
+        with zipfile.ZipFile(buf, 'w') as archive:
+            archive.writestr('content.xml', content)
+        buf.seek(0)
+        self.assertEqual(list(iter_sheet_rows(buf)), [
+            ['name', 'a  b'], ['x', 'x'], ['', ''], ['', ''], ['y', 'y']])
+        buf.seek(0)
+        self.assertEqual(read_header(buf), ['name', 'a  b'])
+        buf.seek(0)
+        self.assertEqual(ODSReader(buf).getSheet('two'), [['other']])
+
+    def test_parsed_file_cache(self):
+        def create_log():
+            return ImportLog.objects.create(
+                name="test",
+                user=self.user,
+                import_file=ContentFile(b"name,,user\nfoo,skip,1\nbar,,2\n", name="rows.csv"),
+                import_setting=self.import_setting,
+                import_type='N',
+            )
+        with tempfile.TemporaryDirectory() as cache_dir:
+            with self.settings(SIMPLE_IMPORT_CACHE_DIR=cache_dir):
+                import_log = create_log()
+                with closing(import_log.iter_import_rows()) as rows:
+                    next(rows)
+                # A partial read isn't cached
+                self.assertEqual(os.listdir(cache_dir), [])
+                rows = list(import_log.iter_import_rows())
+                self.assertEqual(rows, [['name', 'user'], ['foo', '1'], ['bar', '2']])
+                self.assertEqual(len(os.listdir(cache_dir)), 1)
+
+                def fail(import_file):
+                    raise AssertionError("File parsed again")
+                with mock.patch.dict(READERS, {'csv': fail}):
+                    import_log = ImportLog.objects.get(pk=import_log.pk)
+                    self.assertEqual(list(import_log.iter_import_rows()), rows)
+
+                # The hash is saved on the log, reads don't download the
+                # file again to work it out
+                self.assertEqual(import_log.file_hash, hashlib.sha1(
+                    b"name,,user\nfoo,skip,1\nbar,,2\n").hexdigest())
+                with mock.patch.object(cache, 'get_file_hash', side_effect=AssertionError):
+                    import_log = ImportLog.objects.get(pk=import_log.pk)
+                    with closing(import_log.iter_import_rows()) as preview:
+                        self.assertEqual(list(islice(preview, 2)), rows[:2])
+                    self.assertEqual(list(import_log.iter_import_rows()), rows)
+
+                # Too big to cache, and doesn't push out the spool that fits
+                spools = os.listdir(cache_dir)
+                with self.settings(SIMPLE_IMPORT_CACHE_SIZE=1):
+                    self.assertEqual(list(create_log().iter_import_rows()), rows)
+                self.assertEqual(os.listdir(cache_dir), spools)
+
+    def test_spool(self):
+        """ Columns keep their types and any row can be read on its own """
+        when = datetime.datetime(2020, 1, 2, 3, 4)
+        rows = [['name', 'count', 'price', 'when']] + [
+            ['row %d é' % i, i if i % 7 else None, i / 4, when if i % 2 else 'n/a']
+            for i in range(2500)]
+        with tempfile.TemporaryDirectory() as cache_dir:
+            path = os.path.join(cache_dir, 'rows.spool')
+            self.assertEqual(list(cache.write_through(iter(rows), path)), rows)
+            with cache.Spool(path) as spool:
+                self.assertEqual(len(spool), len(rows))
+                self.assertEqual(list(spool), rows)
+                self.assertEqual(spool.row(0), rows[0])
+                self.assertEqual(spool.row(1501), rows[1501])
+                self.assertEqual(list(spool.iter_rows(995, 1005)), rows[995:1005])
+                self.assertEqual(spool.groups[1][1][1][0], cache.INTEGER)
+                self.assertEqual(spool.groups[1][1][2][0], cache.FLOAT)
+                self.assertEqual(spool.groups[1][1][3][0], cache.OBJECT)
+                with self.assertRaises(IndexError):
+                    spool.row(len(rows))
+
+            # Every type a reader returns comes back as it went in
+            from decimal import Decimal
+            cells = [[
+                'mixed', True, datetime.date(2020, 1, 2), datetime.time(3, 4, 5),
+                datetime.timedelta(days=1, seconds=2), Decimal('1.50'), 2 ** 70, None,
+                datetime.datetime(2020, 1, 2, 3, 4, tzinfo=datetime.timezone.utc)]]
+            typed_path = os.path.join(cache_dir, 'typed.spool')
+            list(cache.write_through(iter(cells), typed_path))
+            with cache.Spool(typed_path) as spool:
+                self.assertEqual(list(spool), cells)
+            os.remove(typed_path)
+
+            # Writing stops at the first group past the size limit
+            os.remove(path)
+            with self.settings(SIMPLE_IMPORT_CACHE_SIZE=1024), mock.patch.object(
+                    cache.SpoolWriter, 'write_group', autospec=True,
+                    side_effect=cache.SpoolWriter.write_group) as write_group:
+                self.assertEqual(list(cache.write_through(iter(rows), path)), rows)
+            self.assertEqual(write_group.call_count, 1)
+            self.assertEqual(os.listdir(cache_dir), [])
+
+    def test_bad_spool(self):
+        """ A spool that can't be read is parsed again and replaced """
+        lines = ['name,note'] + ['row %d,note %d' % (i, i) for i in range(1500)]
+        expected = [line.split(',') for line in lines]
+        with tempfile.TemporaryDirectory() as cache_dir, self.settings(
+                SIMPLE_IMPORT_CACHE_DIR=cache_dir):
+            import_log = ImportLog.objects.create(
+                name="test",
+                user=self.user,
+                import_file=ContentFile('\n'.join(lines).encode(), name="rows.csv"),
+                import_setting=self.import_setting,
+                import_type='N',
+            )
+            self.assertEqual(list(import_log.iter_import_rows()), expected)
+            spool_path = cache.get_spool_path(import_log)
+
+            # Not a spool at all
+            with open(spool_path, 'wb') as spool:
+                spool.write(b'junk')
+            with self.assertLogs('simple_import.models', 'WARNING'):
+                self.assertIsNone(import_log.open_spool())
+            self.assertFalse(os.path.exists(spool_path))
+            with open(spool_path, 'wb') as spool:
+                spool.write(b'junk')
+            with self.assertLogs('simple_import.models', 'WARNING'):
+                self.assertEqual(list(import_log.iter_import_rows()), expected)
+            with import_log.open_spool() as spool:
+                self.assertEqual(len(spool), len(expected))
+
+            # Fails part way, after the first group of rows
+            with cache.Spool(spool_path) as spool:
+                kind, nulls, offset, length, index = spool.groups[1][1][0]
+            with open(spool_path, 'r+b') as spool:
+                spool.seek(offset)
+                spool.write(b'\xff')
+            with self.assertLogs('simple_import.models', 'WARNING'):
+                self.assertEqual(list(import_log.iter_import_rows()), expected)
+            with import_log.open_spool() as spool:
+                self.assertEqual(list(spool), expected)
+
+            # Goes with the log
+            import_log.delete()
+            self.assertEqual(os.listdir(cache_dir), [])
+
+    def test_spool_safety(self):
+        """ A spool planted in the cache can't run code """
+        import pickle
+
+        class Exploit(object):
+            def __reduce__(self):
+                return (os.remove, (marker,))
+
+        with tempfile.TemporaryDirectory() as cache_dir:
+            marker = os.path.join(cache_dir, 'marker')
+            open(marker, 'w').close()
+            path = os.path.join(cache_dir, 'planted.spool')
+            with open(path, 'wb') as planted:
+                footer = pickle.dumps(Exploit())
+                planted.write(cache.MAGIC + footer + cache.FOOTER_OFFSET.pack(len(cache.MAGIC)))
+            with self.assertRaises(ValueError):
+                cache.Spool(path)
+            self.assertTrue(os.path.exists(marker))
+
+            # The shared default directory must be ours alone
+            private = os.path.join(cache_dir, 'simple_import')
+            self.assertTrue(cache.make_private_dir(private))
+            self.assertEqual(os.stat(private).st_mode & 0o777, 0o700)
+            os.chmod(private, 0o777)
+            self.assertTrue(cache.make_private_dir(private))
+            self.assertEqual(os.stat(private).st_mode & 0o777, 0o700)
+            os.symlink(private, os.path.join(cache_dir, 'link'))
+            with self.assertLogs('simple_import.cache', 'WARNING'):
+                self.assertFalse(cache.make_private_dir(os.path.join(cache_dir, 'link')))
+
+    def test_csv_reader(self):
+        rows = [['name', 'note'], ['Zoë', 'a "quoted"\nnote'], ['Ann', 'x;y']]
+        for encoding in ('utf-8', 'utf-8-sig', 'cp1252', 'utf-16'):
+            buf = io.StringIO(newline='')
+            csv.writer(buf, delimiter=';').writerows(rows)
+            data = io.BytesIO(buf.getvalue().encode(encoding))
+            self.assertEqual(list(iter_csv_rows(data)), rows, encoding)
+
+        data = io.BytesIO('name,note\r\nZoë,"multi\r\nline"\r\nAnn,x\r\n'.encode('utf-8'))
+        records = list(iter_csv_records(data))
+        self.assertEqual([row for offset, row in records], [
+            ['name', 'note'], ['Zoë', 'multi\r\nline'], ['Ann', 'x']])
+        self.assertEqual(records[-1][0], len(data.getvalue()))
+        # Carry on after the second record
+        self.assertEqual(list(iter_csv_records(data, start=records[1][0])), records[2:])
+        # The upload is left open for the next reader
+        self.assertFalse(data.closed)
+
+    def test_xls_reader(self):
+        with open(self.absolute_path, 'rb') as fp:
+            data = fp.read()
+        rows = list(readers.iter_xls_rows(ContentFile(data)))
+        # Read a column at a time, in blocks that don't line up with the rows
+        with mock.patch.object(readers, 'XLS_BLOCK_SIZE', 2):
+            self.assertEqual(list(readers.iter_xls_rows(self.import_log.import_file)), rows)
+        self.assertEqual(readers.read_xls_header(ContentFile(data)), rows[0])
+        self.assertEqual(convert_xls_dates([61, 43831.75], 0), [
+            datetime.datetime(1900, 3, 1), datetime.datetime(2020, 1, 1, 18)])
+        self.assertEqual(convert_xls_dates([1.5], 1), [datetime.datetime(1904, 1, 2, 12)])
+
+    def test_bulk_create_bisects_failed_batch(self):
+        """ Only the rows that break a batch insert should fail """
+        class FlakyImporter(Importer):
+            def insert_objects(self, objects):
+                if any(obj.name == 'bad' for obj in objects):
+                    raise IntegrityError('bad row')
+
+        ColumnMatch.objects.create(
+            column_name='name', field_name='name',
+            import_setting=self.import_setting, header_position=0)
+        importer = FlakyImporter(self.import_log, self.user)
+        importer.prepare(['name'])
+        rows = [['a'], ['b'], ['bad'], ['c'], ['d']]
+        importer.write_batch([(row, importer.build_object(row)) for row in rows])
+        self.assertEqual(importer.create_count, 4)
+        self.assertEqual(importer.fail_count, 1)
+        self.assertEqual(importer.error_data[1], ['bad', 'Integrity Error', 'bad row'])
+
+    def test_bulk_update(self):
+        """ Only Update imports fetch each chunk of keys in one query """
+        target = ImportLog.objects.create(
+            name='old name', user=self.user,
+            import_file=ContentFile(b"", name="target.csv"),
+            import_setting=self.import_setting, import_type='N')
+        import_log = ImportLog.objects.create(
+            name="test",
+            user=self.user,
+            import_file=ContentFile(
+                "id,name\n{0},new name\n999,missing\n".format(target.pk).encode(),
+                name="update.csv"),
+            import_setting=self.import_setting,
+            import_type='O',
+            update_key='id',
+        )
+        for i, name in enumerate(['id', 'name']):
+            ColumnMatch.objects.create(
+                column_name=name, field_name=name,
+                import_setting=self.import_setting, header_position=i)
+        importer = Importer(import_log, self.user, commit=True).run()
+        # Django < 2.2 falls back to saving row by row, with the same results
+        self.assertEqual(importer.can_bulk_upsert(), hasattr(QuerySet, 'bulk_update'))
+        self.assertEqual(importer.update_count, 1)
+        self.assertEqual(importer.fail_count, 1)
+        self.assertEqual(importer.error_data[1][2], "No Record Found to Update")
+        target.refresh_from_db()
+        self.assertEqual(target.name, 'new name')
+
+    def test_bulk_update_m2m_only(self):
+        """ Rows with only a key and m2m cells just add their links """
+        from django.contrib.auth.models import Group
+        group = Group.objects.create(name='a')
+        import_log = self.create_import_log(
+            Group, "id,permissions\n{0},add_group\n".format(group.pk).encode(),
+            ['id', 'permissions'], import_type='O', update_key='id')
+        RelationalMatch.objects.create(
+            import_log=import_log, field_name='permissions', related_field_name='codename')
+        importer = Importer(import_log, self.user, commit=True).run()
+        self.assertEqual(importer.can_bulk_upsert(), hasattr(QuerySet, 'bulk_update'))
+        self.assertEqual((importer.update_count, importer.fail_count), (1, 0))
+        self.assertEqual(
+            list(group.permissions.values_list('codename', flat=True)), ['add_group'])
+        self.assertEqual(import_log.importedobject_set.count(), 1)
+
+        # Receivers of the m2m field's signal still hear about new links
+        from django.db.models.signals import m2m_changed
+        receiver = mock.Mock()
+        m2m_changed.connect(receiver, sender=Group.permissions.through)
+        try:
+            import_log = self.create_import_log(
+                Group, "id,permissions\n{0},change_group\n".format(group.pk).encode(),
+                ['id', 'permissions'], import_type='O', update_key='id')
+            RelationalMatch.objects.create(
+                import_log=import_log, field_name='permissions', related_field_name='codename')
+            Importer(import_log, self.user, commit=True).run()
+        finally:
+            m2m_changed.disconnect(receiver, sender=Group.permissions.through)
+        self.assertIn('post_add', [call[1]['action'] for call in receiver.call_args_list])
+        self.assertEqual(group.permissions.count(), 2)
+
+    def test_bulk_update_collation(self):
+        """ Keys are matched like the database does, not only by equality """
+        target = ImportLog.objects.create(
+            name='abc', user=self.user,
+            import_file=ContentFile(b"", name="target.csv"),
+            import_setting=self.import_setting, import_type='N')
+        import_log = ImportLog.objects.create(
+            name="test",
+            user=self.user,
+            import_file=ContentFile(b"name,update_key\nABC,changed\nnew,x\n", name="update.csv"),
+            import_setting=self.import_setting,
+            import_type='O',
+            update_key='name',
+        )
+        for i, name in enumerate(['name', 'update_key']):
+            ColumnMatch.objects.create(
+                column_name=name, field_name=name,
+                import_setting=self.import_setting, header_position=i)
+        with case_insensitive(ImportLog, 'name'):
+            importer = Importer(import_log, self.user, commit=True).run()
+        self.assertEqual(importer.update_count, 1)
+        self.assertEqual(importer.error_data[1][:3], ['new', 'x', "No Record Found to Update"])
+        target.refresh_from_db()
+        self.assertEqual((target.name, target.update_key), ('ABC', 'changed'))
+
+    def test_bulk_create_returning_pks(self):
+        """ On backends that return primary keys from bulk inserts new
+        records are created in batches with their m2m links and tracking """
+        from django.contrib.auth.models import Group
+        real_bulk_create = QuerySet.bulk_create
+
+        def bulk_create(queryset, objs, *args, **kwargs):
+            objs = real_bulk_create(queryset, objs, *args, **kwargs)
+            if queryset.model is Group:
+                # Like a backend with RETURNING
+                pks = dict(Group.objects.filter(
+                    name__in=[obj.name for obj in objs]).values_list('name', 'pk'))
+                for obj in objs:
+                    obj.pk = pks[obj.name]
+                    obj._state.adding = False
+                    obj._state.db = queryset.db
+            return objs
+
+        import_log = self.create_import_log(
+            Group, b"name,permissions\na,add_group\nb,change_group\na,add_group\nc,\n",
+            ['name', 'permissions'])
+        RelationalMatch.objects.create(
+            import_log=import_log, field_name='permissions', related_field_name='codename')
+        group_type = ContentType.objects.get_for_model(Group)
+        for compact_tracking in [False, True]:
+            with self.settings(SIMPLE_IMPORT_COMPACT_TRACKING=compact_tracking), \
+                    mock.patch('simple_import.importer.can_return_bulk_pks', return_value=True), \
+                    mock.patch.object(QuerySet, 'bulk_create', bulk_create):
+                importer = Importer(import_log, self.user, commit=True).run()
+                self.assertTrue(importer.can_bulk_create())
+            self.assertEqual((importer.create_count, importer.fail_count), (3, 1))
+            self.assertEqual(importer.error_data[1][:3], ['a', 'add_group', 'Integrity Error'])
+            groups = {group.name: group for group in Group.objects.all()}
+            self.assertEqual(sorted(groups), ['a', 'b', 'c'])
+            self.assertEqual(
+                sorted(Group.permissions.through.objects.values_list('group_id', 'permission__codename')),
+                sorted([(groups['a'].pk, 'add_group'), (groups['b'].pk, 'change_group')]))
+            self.assertEqual(import_log.importedblock_set.exists(), compact_tracking)
+            self.assertEqual(
+                sorted(import_log.iter_imported_keys()),
+                sorted((group_type.pk, group.pk) for group in groups.values()))
+            import_log.undo()
+            self.assertFalse(Group.objects.exists())
+            self.assertFalse(import_log.importedobject_set.exists())
+            self.assertFalse(import_log.importedblock_set.exists())
+
+    def test_bulk_create_file_pks(self):
+        """ Primary keys from the file are kept when a failed batch is
+        split and retried """
+        from django.contrib.sessions.models import Session
+        import_log = self.create_import_log(
+            Session, "session_key,session_data,expire_date\n".encode() + "".join(
+                "{0},data,2030-01-01T00:00:00+00:00\n".format(key)
+                for key in ['k1', 'k2', 'k3', 'k1']).encode(),
+            ['session_key', 'session_data', 'expire_date'])
+        with mock.patch('simple_import.importer.can_return_bulk_pks', return_value=True):
+            importer = Importer(import_log, self.user, commit=True).run()
+            self.assertTrue(importer.can_bulk_create())
+        self.assertEqual((importer.create_count, importer.fail_count), (3, 1))
+        self.assertEqual(importer.error_data[1][0], 'k1')
+        self.assertEqual(
+            sorted(Session.objects.filter(session_data='data').values_list('pk', flat=True)),
+            ['k1', 'k2', 'k3'])
+
+    def test_import_plan(self):
+        """ The row loop shouldn't query for match metadata """
+        for i, name in enumerate(['name', 'user']):
+            ColumnMatch.objects.create(
+                column_name=name, field_name=name,
+                import_setting=self.import_setting, header_position=i)
+        RelationalMatch.objects.create(
+            import_log=self.import_log, field_name='user',
+            related_field_name='username')
+        importer = Importer(self.import_log, self.user)
+        importer.prepare(['name', 'user'])
+        self.assertEqual(
+            [column.kind for column in importer.columns],
+            [ImportColumn.PLAIN, ImportColumn.FOREIGN_KEY])
+        self.assertEqual(importer.columns[1].related_model, User)
+        # One user lookup, then the key index is used
+        with self.assertNumQueries(1):
+            for row in [['a', 'temporary'], ['b', 'temporary']]:
+                new_object = importer.build_object(row)
+                self.assertEqual(new_object.user, self.user)
+
+    def test_get_matches_queries(self):
+        """ Matching a wide header costs the same few queries """
+        ColumnMatch.objects.create(
+            column_name='Name', field_name='name',
+            import_setting=self.import_setting, header_position=5)
+        header_row = ['name', 'import_type'] + ['extra %d' % i for i in range(50)]
+        import_log = ImportLog.objects.get(pk=self.import_log.pk)
+        # setting, matches, content type, insert, update, result
+        with self.assertNumQueries(6):
+            matches = list(import_log.get_matches(header_row=header_row))
+        self.assertEqual(len(matches), 52)
+        self.assertEqual(
+            [(match.column_name, match.field_name, match.header_position) for match in matches[:2]],
+            [('Name', 'name', 0), ('import_type', 'import_type', 1)])
+        importer = Importer(import_log, self.user)
+        with self.assertNumQueries(2):
+            importer.prepare(header_row)
+        self.assertEqual(importer.columns[0].field_name, 'name')
+
+    def test_validate_match_columns(self):
+        from .views import validate_match_columns
+        ColumnMatch.objects.create(
+            column_name='Name', field_name='name',
+            import_setting=self.import_setting, header_position=0)
+        ColumnMatch.objects.create(
+            column_name='type', field_name='import_type',
+            import_setting=self.import_setting, header_position=1)
+        with self.assertNumQueries(1):
+            errors = validate_match_columns(self.import_log, ImportLog, ['name', 'other'])
+        errors = {error.field_name: error for error in errors}
+        self.assertNotIn('name', errors)
+        self.assertEqual(errors['import_type'].code, 'not_in_spreadsheet')
+        self.assertEqual(str(errors['import_type']), "Import Type is required but is not in your spreadsheet. ")
+        self.assertEqual(errors['import_file'].as_dict(), {
+            'code': 'no_match',
+            'message': "Import File is required but has no match.",
+            'field_name': 'import_file'})
+
+    def test_column_converters(self):
+        is_empty = ImportLog.is_empty
+        choice = ImportColumn(ImportLog, 'import_type').compile(is_empty)
+        boolean = ImportColumn(ImportLog, 'commit', default_value='yes').compile(is_empty)
+        import_log = ImportLog()
+        for cell, expected in [('Only Update Records', 'O'), ('U', 'U'), ('bogus', 'U')]:
+            choice(import_log, cell)
+            self.assertEqual(import_log.import_type, expected)
+        for cell, expected in [('FALSE', False), (' Yes ', True), (0, False), ('', True)]:
+            boolean(import_log, cell)
+            self.assertEqual(import_log.commit, expected)
+
+    def test_parse_chunk(self):
+        from decimal import Decimal
+        from django.db import models
+        is_empty = ImportLog.is_empty
+        parsers = [
+            ColumnParser(0, 'Count', models.IntegerField(), INTEGER, is_empty),
+            ColumnParser(1, 'Price', models.DecimalField(max_digits=5, decimal_places=2), DECIMAL, is_empty),
+            ColumnParser(2, 'Weight', models.FloatField(), FLOAT, is_empty),
+            ColumnParser(3, 'Day', models.DateField(), DATE, is_empty),
+            ColumnParser(4, 'Active', models.BooleanField(), BOOLEAN, is_empty),
+        ]
+        rows = [
+            [' 3 ', '1.50', '2.5', '2020-01-02', 'Yes'],
+            [4.0, '', 1, datetime.datetime(2020, 1, 3, 4, 5), 'n'],
+            ['4.5', '1', '1', '2020-01-02', 'yes'],
+            ['1', 'abc', 'x', '2020-13-45', 'maybe'],
+        ]
+        parsed_rows, errors = parse_chunk(parsers, rows)
+        self.assertEqual(parsed_rows, [
+            [3, Decimal('1.50'), 2.5, datetime.date(2020, 1, 2), True],
+            [4, '', 1.0, datetime.date(2020, 1, 3), False],
+        ])
+        # The rows as read, failed on their first bad cell
+        self.assertEqual([(row, exc.type_name) for row, exc in errors], [
+            (rows[2], 'Integer'),
+            (rows[3], 'Decimal'),
+        ])
+        self.assertTrue(errors[0][1].messages[0].startswith('Count: '))
+
+    @skipUnless(get_numpy(), "NumPy is not installed")
+    def test_parse_chunk_numpy(self):
+        """ Columns NumPy converts in one go take the same cells as to_python """
+        from django.db import models
+        is_empty = ImportLog.is_empty
+        parsers = [
+            ColumnParser(0, 'Count', models.IntegerField(), INTEGER, is_empty),
+            ColumnParser(1, 'Weight', models.FloatField(), FLOAT, is_empty),
+        ]
+        rows = [[' 3 ', '1e3'], [4.0, 2], ['-12', '12.5']]
+        with mock.patch.object(ColumnParser, 'to_python') as to_python:
+            parsed_rows, errors = parse_chunk(parsers, rows)
+        self.assertFalse(to_python.called)
+        self.assertEqual(parsed_rows, [[3, 1000.0], [4, 2.0], [-12, 12.5]])
+        self.assertEqual(errors, [])
+
+        # int() refuses these, so they go through the field cell by cell
+        rows = [['1e3'], ['12.0'], ['7']]
+        parsed_rows, errors = parse_chunk(parsers[:1], rows)
+        self.assertEqual(parsed_rows, [[7]])
+        self.assertEqual([row for row, exc in errors], rows[:2])
+
+        # and so do integers too big to go through a float exactly
+        parsed_rows, errors = parse_chunk(parsers[:1], [[str(2 ** 53 + 1)]])
+        self.assertEqual(parsed_rows, [[2 ** 53 + 1]])
+
+    @override_settings(SIMPLE_IMPORT_TYPED_PARSING=True)
+    def test_typed_parsing(self):
+        """ Cells that don't convert fail before the object is built """
+        import_log = self.create_import_log(
+            User, b"username,is_active\nann,no\nbob,maybe\ncal,\n", ['username', 'is_active'])
+        importer = Importer(import_log, self.user, commit=True).run()
+        self.assertEqual(importer.rows_done, 3)
+        self.assertEqual(importer.create_count, 2)
+        self.assertEqual(importer.error_data[1][:3], ['bob', 'maybe', 'Invalid Boolean'])
+        self.assertFalse(User.objects.get(username='ann').is_active)
+        self.assertTrue(User.objects.get(username='cal').is_active)
+
+    def test_related_key_index(self):
+        other = User.objects.create_user('other', 'other@example.com', 'other')
+        index = RelatedKeyIndex(User, 'username', max_size=2)
+        with self.assertNumQueries(1):
+            index.load(['other', 'temporary', 'other'])
+            self.assertEqual(index.get('temporary'), self.user)
+            self.assertEqual(index.get('other'), other)
+            self.assertEqual(index.get('temporary'), self.user)
+        with self.assertRaises(User.DoesNotExist):
+            index.get('nobody')
+        # Capped at two keys, the least recently used was dropped
+        self.assertEqual(list(index.objects), ['temporary', 'nobody'])
+
+        # No cache at all, every key is queried
+        index = RelatedKeyIndex(User, 'username', max_size=0)
+        with self.assertNumQueries(2):
+            index.load(['other', 'temporary'])
+            self.assertEqual(index.get('other'), other)
+            self.assertEqual(index.get('other'), other)
+        self.assertEqual(len(index.objects), 0)
+
+        # Keys the database matches without them being equal. The other
+        # keys of that batch are then looked up one at a time.
+        index = RelatedKeyIndex(User, 'username')
+        with case_insensitive(User, 'username'):
+            with self.assertNumQueries(3):
+                index.load(['OTHER', 'Nobody'])
+                self.assertEqual(index.get('OTHER'), other)
+            with self.assertRaises(User.DoesNotExist):
+                index.get('Nobody')
+
+    @override_settings(SIMPLE_IMPORT_COMMIT_CHUNK_SIZE=2)
+    def test_chunked_commit_resume(self):
+        from django.contrib.auth.models import Group
+        import_log = self.create_import_log(Group, b"name\na\nb\nc\nd\ne\n")
+        import_log.last_committed_row = 3
+        import_log.create_count = 3
+        Importer(import_log, self.user, commit=True, resume=True).run()
+        self.assertEqual(
+            list(Group.objects.values_list('name', flat=True)), ['d', 'e'])
+        import_log.refresh_from_db()
+        self.assertEqual(import_log.last_committed_row, 5)
+        self.assertEqual(import_log.create_count, 5)
+        # The rows came from the csv file, so did the offset
+        self.assertEqual(import_log.last_committed_offset, len(b"name\na\nb\nc\nd\ne\n"))
+
+        # Without a spool the csv file is read from the saved offset
+        Group.objects.all().delete()
+        import_log.delete_spool()
+        ImportLog.objects.filter(pk=import_log.pk).update(
+            last_committed_row=3, last_committed_offset=len(b"name\na\nb\nc\n"), create_count=3)
+        import_log = ImportLog.objects.get(pk=import_log.pk)
+        with mock.patch('simple_import.models.iter_csv_records', wraps=iter_csv_records) as records:
+            Importer(import_log, self.user, commit=True, resume=True).run()
+        self.assertEqual(records.call_args_list[-1][0][1], len(b"name\na\nb\nc\n"))
+        self.assertEqual(
+            list(Group.objects.values_list('name', flat=True)), ['d', 'e'])
+        import_log.refresh_from_db()
+        self.assertEqual(
+            (import_log.last_committed_row, import_log.last_committed_offset),
+            (5, len(b"name\na\nb\nc\nd\ne\n")))
+
+    @override_settings(SIMPLE_IMPORT_PARALLEL_WORKERS=4)
+    def test_validate_dry_run(self):
+        """ Simulations check rows in memory instead of writing them """
+        from django.contrib.auth.models import Group
+        Group.objects.create(name='b')
+        import_log = self.create_import_log(
+            Group, "name\na\nb\na\nc\n{0}\n".format('x' * 200).encode())
+        # Hashed like start_import does on upload, so the run writes nothing
+        import_log.get_file_hash()
+        importer = Importer(import_log, self.user)
+        with CaptureQueriesContext(connection) as queries:
+            importer.run()
+        self.assertFalse(any(
+            query['sql'].startswith(('INSERT', 'UPDATE', 'SAVEPOINT'))
+            for query in queries.captured_queries))
+        self.assertEqual(importer.create_count, 2)
+        self.assertEqual(importer.fail_count, 3)
+        self.assertEqual([row[:2] for row in importer.error_data[1:]], [
+            ['b', 'Integrity Error'],
+            ['a', 'Integrity Error'],
+            ['x' * 200, 'Validation Error']])
+
+        with self.settings(SIMPLE_IMPORT_VALIDATE_DRY_RUN=False):
+            saved = Importer(import_log, self.user).run()
+        # sqlite doesn't enforce max_length, the rest fails the same way
+        self.assertEqual(
+            [row[:2] for row in saved.error_data[1:]],
+            [row[:2] for row in importer.error_data[1:3]])
+        self.assertEqual(Group.objects.count(), 1)
+
+    def test_validate_dry_run_constraints(self):
+        """ Simulations in memory catch the same NOT NULL and unique errors
+        as saving """
+        from django.contrib.auth.models import Group
+        first = Group.objects.create(name='a')
+        second = Group.objects.create(name='b')
+        missing = first.pk + second.pk
+        import_log = self.create_import_log(
+            Group, "id,name\n{0},a\n{1},a\n{1},c\n{2},c\n{2},d\n".format(
+                first.pk, second.pk, missing).encode(),
+            ['id', 'name'], import_type='U', update_key='id')
+        importer = Importer(import_log, self.user).run()
+        self.assertTrue(importer.can_validate_only())
+        self.assertEqual((importer.create_count, importer.update_count, importer.fail_count), (1, 2, 2))
+        with self.settings(SIMPLE_IMPORT_VALIDATE_DRY_RUN=False):
+            saved = Importer(import_log, self.user).run()
+        self.assertEqual(
+            [row[:3] for row in importer.error_data[1:]],
+            [row[:3] for row in saved.error_data[1:]])
+        self.assertEqual([row[2] for row in importer.error_data[1:]], ['Integrity Error'] * 2)
+
+        # A column match without the required import setting
+        import_log = self.create_import_log(ColumnMatch, b"column_name\nx\n", ['column_name'])
+        importer = Importer(import_log, self.user).run()
+        self.assertTrue(importer.can_validate_only())
+        with self.settings(SIMPLE_IMPORT_VALIDATE_DRY_RUN=False):
+            saved = Importer(import_log, self.user).run()
+        self.assertEqual(importer.fail_count, 1)
+        self.assertEqual(importer.error_data[1][:2], saved.error_data[1][:2])
+
+    @override_settings(SIMPLE_IMPORT_ERROR_PREVIEW_SIZE=1)
+    def test_error_report(self):
+        """ Failed rows are written to the error file, pages only show a few """
+        from django.contrib.auth.models import Group
+        import_log = self.create_import_log(Group, b"name\na\na\na\n")
+        response = self.client.get(reverse(
+            'simple_import-do_import', kwargs={'import_log_id': import_log.id}))
+        import_log.refresh_from_db()
+        self.assertEqual(import_log.fail_count, 2)
+        self.assertTrue(str(import_log.error_file).endswith('.xlsx'))
+        self.assertEqual(response.context['error_header'], [
+            ['name', 'Error Type', 'Error Details']])
+        self.assertEqual(len(response.context['error_rows']), 1)
+        self.assertEqual(response.context['error_rows'][0][:2], ['a', 'Integrity Error'])
+        self.assertEqual(len(import_log.get_error_preview(10)), 3)
+
+    def test_undo(self):
+        from django.contrib.auth.models import Group
+        import_log = self.create_import_log(Group, b"name\na\nb\nc\n")
+        Group.objects.create(name='kept')
+        Importer(import_log, self.user, commit=True).run()
+        self.assertEqual(import_log.importedobject_set.count(), 3)
+
+        response = self.client.get(reverse(
+            'simple_import-do_import', kwargs={'import_log_id': import_log.id}) + '?undo=True')
+        self.assertRedirects(
+            response, reverse('simple_import-do_import', kwargs={'import_log_id': import_log.id}) +
+            '?success_undo=True', fetch_redirect_response=False)
+        self.assertEqual(list(Group.objects.values_list('name', flat=True)), ['kept'])
+        self.assertFalse(import_log.importedobject_set.exists())
+        import_log.refresh_from_db()
+        self.assertEqual(import_log.status, "")
+
+        # Nothing refers to column matches, so they're deleted in one query
+        column_matches = ColumnMatch.objects.filter(import_setting_id=import_log.import_setting_id)
+        with self.assertNumQueries(1):
+            delete_objects(column_matches)
+        self.assertFalse(column_matches.exists())
+
+    @override_settings(SIMPLE_IMPORT_COMPACT_TRACKING=True)
+    def test_compact_tracking(self):
+        from django.contrib.auth.models import Group
+        import uuid
+        block = ImportedBlock.from_keys(
+            self.import_log, self.import_setting.content_type,
+            [7, 3, 4, 5, 9, 2 ** 40, uuid.UUID(int=1)])
+        self.assertEqual(list(block.iter_ranges()), [(3, 5), (7, 7), (9, 9), (2 ** 40, 2 ** 40)])
+        self.assertEqual(list(block.iter_keys()), [
+            3, 4, 5, 7, 9, 2 ** 40, '00000000-0000-0000-0000-000000000001'])
+        self.assertEqual(block.count_keys(), 7)
+
+        import_log = self.create_import_log(Group, b"name\na\nb\nc\na\n")
+        Importer(import_log, self.user, commit=True).run()
+        self.assertFalse(import_log.importedobject_set.exists())
+        self.assertEqual(import_log.importedblock_set.count(), 1)
+        group_type = ContentType.objects.get_for_model(Group)
+        self.assertEqual(
+            sorted(import_log.iter_imported_keys()),
+            sorted((group_type.pk, pk) for pk in Group.objects.values_list('pk', flat=True)))
+        import_log.undo()
+        self.assertFalse(Group.objects.exists())
+        self.assertFalse(import_log.importedblock_set.exists())
+
+    def test_model_info(self):
+        from django.contrib.auth.models import Group
+        from .utils import clear_model_info, get_all_field_names, get_model_info
+        info = get_model_info(Group)
+        self.assertIs(get_model_info(Group), info)
+        self.assertIn('name', info.unique)
+        self.assertIn('name', info.required)
+        self.assertNotIn('permissions', info.required)
+        self.assertEqual(info.related_models['permissions'].__name__, 'Permission')
+        # Callers change the list they get
+        get_all_field_names(Group).remove('name')
+        self.assertIn('name', get_all_field_names(Group))
+        clear_model_info()
+        self.assertIsNot(get_model_info(Group), info)
+
+    def test_guess_field(self):
+        from django.contrib.auth.models import Group
+        from .utils import ModelInfo, get_model_info
+        info = get_model_info(ImportLog)
+        self.assertEqual(info.guess_field_name('name'), 'name')
+        self.assertEqual(info.guess_field_name('Import-Type'), 'import_type')
+        self.assertEqual(info.guess_field_name('USER ID'), 'user_id')
+        self.assertEqual(info.guess_field_name('date created'), 'date')
+        self.assertIsNone(info.guess_field_name('imprt typ'))
+        self.assertEqual(info.guess_field_name('imprt typ', 0.5), 'import_type')
+        self.assertIsNone(info.guess_field_name('zzz', 0.5))
+
+        Group.simple_import_aliases = {'name': ('Team', 'Group Title')}
+        try:
+            info = ModelInfo(Group)
+            self.assertEqual(info.guess_field_name('group title'), 'name')
+            self.assertEqual(info.guess_field_name('TEAM'), 'name')
+        finally:
+            del Group.simple_import_aliases
+
+    def test_import_partition(self):
+        from django.contrib.auth.models import Group
+        import_log = self.create_import_log(Group, b"name\n")
+        importer = Importer(import_log, self.user, commit=True)
+        importer.prepare(['name'])
+        # sqlite only has one writer
+        self.assertFalse(importer.can_run_parallel())
+
+        result = import_partition(
+            import_log.pk, self.user.pk, True, ['name'], [['a'], ['b'], ['a']])
+        self.assertEqual(result['create_count'], 2)
+        self.assertEqual(result['fail_count'], 1)
+        self.assertEqual(result['error_data'][0][:2], ['a', 'Integrity Error'])
+        self.assertEqual(Group.objects.count(), 2)
+
+        # Spooled imports send workers ranges of rows
+        import_log = self.create_import_log(Group, b"name\nc\nd\ne\n")
+        list(import_log.iter_import_rows())
+        result = import_partition(
+            import_log.pk, self.user.pk, True, ['name'], range(2, 4))
+        self.assertEqual(result['create_count'], 2)
+        self.assertEqual(
+            sorted(Group.objects.values_list('name', flat=True)), ['a', 'b', 'd', 'e'])
+
+    @override_settings(SIMPLE_IMPORT_PARTITION_SIZE=2, SIMPLE_IMPORT_VALIDATE_DRY_RUN=False)
+    def test_run_parallel(self):
+        """ Partitions are sent to the workers and their results merged back
+        in file order """
+        from concurrent.futures import Future
+        from django.contrib.auth.models import Group
+        partitions = []
+
+        class InlineExecutor(object):
+            """ A process pool that runs each partition right away, here """
+            def __init__(self, **kwargs):
+                pass
+
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *exc_info):
+                pass
+
+            def submit(self, func, *args):
+                partitions.append(args[-1])
+                future = Future()
+                future.set_result(func(*args))
+                return future
+
+        import_log = self.create_import_log(Group, b"name\na\na\nb\nc\nd\n")
+        with mock.patch.object(Importer, 'can_run_parallel', return_value=True), \
+                mock.patch('concurrent.futures.ProcessPoolExecutor', InlineExecutor), \
+                mock.patch('simple_import.importer._partition_importer', None):
+            # Read from the file, rows are sent to the workers
+            importer = Importer(import_log, self.user).run()
+            self.assertEqual(partitions, [[['a'], ['a']], [['b'], ['c']], [['d']]])
+            self.assertEqual((importer.create_count, importer.fail_count), (4, 1))
+            self.assertFalse(Group.objects.exists())
+
+            # Spooled, workers read their range of rows from the spool
+            del partitions[:]
+            importer = Importer(import_log, self.user, commit=True).run()
+            self.assertEqual(partitions, [range(1, 3), range(3, 5), range(5, 6)])
+        self.assertEqual(importer.rows_done, 5)
+        self.assertEqual((importer.create_count, importer.fail_count), (4, 1))
+        self.assertEqual(importer.error_data[1][:2], ['a', 'Integrity Error'])
+        self.assertEqual(
+            sorted(Group.objects.values_list('name', flat=True)), ['a', 'b', 'c', 'd'])
+
     def test_import(self):
         """ Make sure we can upload the file and match columns """
         import_log_ct_id = ContentType.objects.get_for_model(ImportLog).id
 
         self.assertEqual(ImportLog.objects.count(), 1)
 
-        with open(self.absolute_path, 'rb') as fp:
+        with open(self.absolute_path, 'rb') as fp, mock.patch.object(
+                cache, 'get_file_hash', wraps=cache.get_file_hash) as get_file_hash:
             response = self.client.post(reverse('simple_import-start_import'), {
                 'name': 'This is a test',
                 'import_file': fp,
@@ -75,6 +1008,11 @@ class SimpleTest(TestCase):
                 'model': import_log_ct_id}, follow=True)
 
         self.assertEqual(ImportLog.objects.count(), 2)
+        # Hashed once on upload, not again for the match columns preview
+        self.assertEqual(get_file_hash.call_count, 1)
+        with open(self.absolute_path, 'rb') as fp:
+            self.assertEqual(
+                ImportLog.objects.all()[1].file_hash, hashlib.sha1(fp.read()).hexdigest())
 
         self.assertRedirects(response, reverse('simple_import-match_columns', kwargs={'import_log_id': ImportLog.objects.all()[1].id}))
         self.assertContains(response, '<h1>Match Columns</h1>')
@@ -148,4 +1086,75 @@ class SimpleTest(TestCase):
         self.assertContains(response, '<h1>Import Results</h1>')
 
         self.assertEqual(RelationalMatch.objects.count(), 2)
+        self.import_log.refresh_from_db()
+        self.assertEqual(self.import_log.status, 'done')
+
+    def test_enqueue_once(self):
+        """ Two requests that both saw the import idle only start one job """
+        from .jobs import enqueue_import, enqueue_undo
+        first = ImportLog.objects.get(pk=self.import_log.pk)
+        second = ImportLog.objects.get(pk=self.import_log.pk)
+        with mock.patch('simple_import.jobs.get_job_runner') as get_job_runner:
+            self.assertTrue(enqueue_import(first, self.user, commit=True))
+            self.assertFalse(enqueue_import(second, self.user, commit=True))
+            self.assertFalse(enqueue_undo(second))
+        self.assertEqual(get_job_runner.return_value.submit.call_count, 1)
+        self.assertEqual(second.status, '')
+        self.import_log.refresh_from_db()
+        self.assertEqual((self.import_log.status, self.import_log.commit), ('queued', True))
+
+    def test_import_status(self):
+        self.import_log.status = 'running'
+        self.import_log.heartbeat = timezone.now()
+        self.import_log.rows_done = 10
+        self.import_log.save()
+        response = self.client.get(reverse(
+            'simple_import-import_status', kwargs={'import_log_id': self.import_log.id}))
+        self.assertEqual(response.json()['status'], 'running')
+        self.assertEqual(response.json()['rows_done'], 10)
+
+        # A running import isn't started again
+        response = self.client.get(reverse(
+            'simple_import-do_import', kwargs={'import_log_id': self.import_log.id}))
+        self.assertContains(response, 'Importing...')
+
+        # Only superusers see other users' imports
+        other = User.objects.create_user('other', 'other@example.com', 'other')
+        other.is_staff = True
+        other.save()
+        self.client.login(username='other', password='other')
+        response = self.client.get(reverse(
+            'simple_import-import_status', kwargs={'import_log_id': self.import_log.id}))
+        self.assertEqual(response.status_code, 400)
+
+    def test_stale_job(self):
+        """ A job that stopped sending heartbeats doesn't block the import """
+        from .jobs import InlineProgressWriter
+        self.import_log.status = 'running'
+        self.import_log.heartbeat = timezone.now() - datetime.timedelta(seconds=60)
+        self.import_log.save()
+        with self.settings(SIMPLE_IMPORT_JOB_TIMEOUT=None):
+            self.assertFalse(self.import_log.fail_if_stale())
+        with self.settings(SIMPLE_IMPORT_JOB_TIMEOUT=120):
+            self.assertFalse(self.import_log.fail_if_stale())
+
+        # The job is still alive if it sent one since the log was loaded
+        stale = ImportLog.objects.get(pk=self.import_log.pk)
+        InlineProgressWriter(self.import_log.pk).save({'rows_done': 5})
+        with self.settings(SIMPLE_IMPORT_JOB_TIMEOUT=30):
+            self.assertFalse(stale.fail_if_stale())
+        self.import_log.refresh_from_db()
+        self.assertEqual((self.import_log.status, self.import_log.rows_done), ('running', 5))
 
+        self.import_log.heartbeat = timezone.now() - datetime.timedelta(seconds=60)
+        self.import_log.save()
+        with self.settings(SIMPLE_IMPORT_JOB_TIMEOUT=30):
+            response = self.client.get(reverse(
+                'simple_import-import_status', kwargs={'import_log_id': self.import_log.id}))
+            self.assertEqual(response.json()['status'], 'failed')
+            # and it can be run again
+            response = self.client.get(reverse(
+                'simple_import-do_import', kwargs={'import_log_id': self.import_log.id}))
+            self.assertNotContains(response, 'Importing...')
+        self.import_log.refresh_from_db()
+        self.assertEqual(self.import_log.status, 'done')
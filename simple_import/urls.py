@@ -6,4 +6,5 @@ urlpatterns = [
     url('^match_columns/(?P<import_log_id>\d+)/$', views.match_columns, name='simple_import-match_columns'),
     url('^match_relations/(?P<import_log_id>\d+)/$', views.match_relations, name='simple_import-match_relations'),
     url('^do_import/(?P<import_log_id>\d+)/$', views.do_import, name='simple_import-do_import'),
+    url('^import_status/(?P<import_log_id>\d+)/$', views.import_status, name='simple_import-import_status'),
 ]
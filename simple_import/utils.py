@@ -1,12 +1,151 @@
-from itertools import chain
+from itertools import chain, islice
+import re
+
+from django.core.signals import setting_changed
+from django.db.models import ForeignKey
+from django.db.models.signals import class_prepared
+from django.utils.encoding import smart_text
+
+NON_WORD = re.compile(r'[\W_]+')
+
+
+class ModelInfo(object):
+    """ Field metadata the matching views look up over and over, worked out
+    once per model. Use get_model_info() rather than building one. """
+    def __init__(self, model_class):
+        opts = model_class._meta
+        self.field_names = tuple(set(chain.from_iterable(
+            (field.name, field.attname) if hasattr(field, 'attname') else (field.name,)
+            for field in opts.get_fields()
+            # For complete backwards compatibility, you may want to exclude
+            # GenericForeignKey from the results.
+            if not (field.many_to_one and field.related_model is None)
+        )))
+        self.fields = {
+            field_name: opts.get_field(field_name) for field_name in self.field_names}
+        self.name_index = {}
+        self.unique = set()
+        # Fields a new record needs a value for, m2m fields included
+        self.required = set()
+        self.related_models = {}
+        self.direct_fields = []
+        for field_name, field in self.fields.items():
+            if not getattr(field, 'blank', True):
+                self.required.add(field_name)
+            if field.concrete:
+                if field.unique:
+                    self.unique.add(field_name)
+                if not field.many_to_many and field.__class__.__name__ != "ForeignKey":
+                    self.direct_fields += [field]
+            if field.many_to_many or isinstance(field, ForeignKey):
+                self.related_models[field_name] = field.related_model
+
+        # Later names win: aliases, then verbose names, attnames and names
+        aliases = getattr(model_class, 'simple_import_aliases', {})
+        for field_name, field_aliases in aliases.items():
+            if isinstance(field_aliases, str):
+                field_aliases = (field_aliases,)
+            for alias in field_aliases:
+                self.name_index[normalize_name(alias)] = field_name
+        for field_name, field in self.fields.items():
+            if hasattr(field, 'verbose_name'):
+                self.name_index[normalize_name(field.verbose_name)] = field_name
+        for field_name, field in self.fields.items():
+            if field_name != field.name:
+                self.name_index[normalize_name(field_name)] = field_name
+        for field_name, field in self.fields.items():
+            if field_name == field.name:
+                self.name_index[normalize_name(field_name)] = field_name
+        self.name_index.pop('', None)
+        self.ngram_index = None
+
+    def get_ngram_index(self):
+        """ Which normalized names contain each trigram, built the first
+        time a fuzzy guess is made """
+        if self.ngram_index is None:
+            self.ngram_index = {}
+            for name in self.name_index:
+                for ngram in get_ngrams(name):
+                    self.ngram_index.setdefault(ngram, set()).add(name)
+        return self.ngram_index
+
+    def guess_field_name(self, column_name, fuzzy_threshold=0):
+        """ The field a column heading most likely refers to, or None.
+        Exact field names win, then normalized names, verbose names and
+        simple_import_aliases. With a fuzzy_threshold between 0 and 1 the
+        closest name by trigram similarity is used when nothing matches
+        exactly. """
+        if column_name in self.fields:
+            return column_name
+        normalized = normalize_name(column_name)
+        if normalized in self.name_index:
+            return self.name_index[normalized]
+        if not fuzzy_threshold or not normalized:
+            return None
+        ngrams = get_ngrams(normalized)
+        ngram_index = self.get_ngram_index()
+        shared = {}
+        for ngram in ngrams:
+            for name in ngram_index.get(ngram, ()):
+                shared[name] = shared.get(name, 0) + 1
+        best_name = None
+        best_score = fuzzy_threshold
+        for name, count in shared.items():
+            # Dice coefficient of the two trigram sets
+            score = 2.0 * count / (len(ngrams) + len(get_ngrams(name)))
+            if score > best_score or (score == best_score and best_name is None):
+                best_name, best_score = name, score
+        return self.name_index[best_name] if best_name is not None else None
+
+
+def normalize_name(name):
+    """ Lower case words joined by underscores: "First Name", "first-name"
+    and "FIRST_NAME" are all first_name """
+    return '_'.join(NON_WORD.split(smart_text(name).lower())).strip('_')
+
+
+def get_ngrams(name):
+    padded = ' {0} '.format(name)
+    return set(padded[i:i + 3] for i in range(len(padded) - 2))
+
+
+_model_info = {}
+
+
+def get_model_info(model_class):
+    """ The ModelInfo for model_class, shared by the whole process """
+    info = _model_info.get(model_class)
+    if info is None:
+        info = _model_info[model_class] = ModelInfo(model_class)
+    return info
+
+
+def clear_model_info(**kwargs):
+    _model_info.clear()
+
+
+# New models, or a reloaded app registry, can change any model's fields
+class_prepared.connect(clear_model_info)
+
+
+def clear_model_info_on_apps_change(setting, **kwargs):
+    if setting == 'INSTALLED_APPS':
+        clear_model_info()
+
+
+setting_changed.connect(clear_model_info_on_apps_change)
 
 
 def get_all_field_names(model_class):
-    return list(set(chain.from_iterable(
-        (field.name, field.attname) if hasattr(field, 'attname') else (field.name,)
-        for field in model_class._meta.get_fields()
-        # For complete backwards compatibility, you may want to exclude
-        # GenericForeignKey from the results.
-        if not (field.many_to_one and field.related_model is None)
-    )))
+    # A new list each time, callers change it
+    return list(get_model_info(model_class).field_names)
+
 
+def chunked(iterable, size):
+    """ Yield lists of up to `size` items from any iterable """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
@@ -1,28 +1,29 @@
 from django import forms
+from django.conf import settings
 from django.contrib.contenttypes.models import ContentType
-from django.contrib.admin.models import LogEntry, ADDITION, CHANGE
 from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib import messages
-from django.conf import settings
 from django.core.exceptions import SuspiciousOperation
 from django.urls import reverse
 from django.db.models import Q, ForeignKey
-from django.db import transaction, IntegrityError
-from django.core.exceptions import ObjectDoesNotExist
 from django.forms.models import inlineformset_factory
-from django.http import HttpResponseRedirect
+from django.http import HttpResponseRedirect, JsonResponse
 from django.shortcuts import render, get_object_or_404, redirect
 from django.template import RequestContext
-import sys
-from django.db.models.fields import AutoField, BooleanField
 from django.utils.encoding import smart_text
+from contextlib import closing
+from itertools import islice
+from django.db.models.fields import AutoField
 from django.contrib.auth import get_user_model
 User = get_user_model()
 
+from . import cache
 from .models import (ImportLog, ImportSetting, ColumnMatch,
-                                  ImportedObject, RelationalMatch)
+                                  RelationalMatch)
 from .forms import ImportForm, MatchForm, MatchRelationForm
-from .utils import get_all_field_names
+from .importer import set_field_from_cell, set_method_from_cell
+from .jobs import enqueue_import, enqueue_undo
+from .utils import get_model_info
 
 
 def is_foreign_key_id_name(field_name, field_object):
@@ -34,36 +35,60 @@ def is_foreign_key_id_name(field_name, field_object):
         return True
 
 
+class MatchError(object):
+    """ A problem with the column matches. str() gives the message shown
+    on the matching page, code and field_name are there for code that
+    wants to handle it, as_dict() for JSON. """
+    def __init__(self, code, message, field_name=None):
+        self.code = code
+        self.message = message
+        self.field_name = field_name
+
+    def __str__(self):
+        return self.message
+
+    def __repr__(self):
+        return '<MatchError {0}: {1}>'.format(self.code, self.message)
+
+    def as_dict(self):
+        return {'code': self.code, 'message': self.message, 'field_name': self.field_name}
+
+
 def validate_match_columns(import_log, model_class, header_row):
     """ Perform some basic pre import validation to make sure it's
     even possible the import can work
-    Returns list of errors
+    Returns list of MatchErrors
     """
     errors = []
-    column_matches = import_log.import_setting.columnmatch_set.all()
-    field_names = get_all_field_names(model_class)
-    for field_name in field_names:
-        field_object = model_class._meta.get_field(field_name)
-        model = field_object.model
-        direct = field_object.concrete
+    # Lower cased column names matched to each field
+    matched_columns = {}
+    for column_name, field_name in import_log.import_setting.columnmatch_set.values_list(
+            'column_name', 'field_name'):
+        matched_columns.setdefault(field_name, set()).add(column_name.lower())
+    header_columns = set(smart_text(cell).lower() for cell in header_row)
+
+    model_info = get_model_info(model_class)
+    for field_name, field_object in model_info.fields.items():
         # Skip if update only and skip ptr which suggests it's a django
         # inherited field. Also some hard coded ones for Django Auth
         if (import_log.import_type != "O" and
                 field_name[-3:] != "ptr" and
                 field_name not in ['password', 'date_joined', 'last_login'] and
                 not is_foreign_key_id_name(field_name, field_object)):
-            if ((direct and model and not field_object.blank) or
-                    (not getattr(field_object, "blank", True))):
-                field_matches = column_matches.filter(field_name=field_name)
-                match_in_header = False
-                if field_matches:
-                    for field_match in field_matches:
-                        if field_match.column_name.lower() in header_row:
-                            match_in_header = True
-                    if not match_in_header:
-                        errors += [u"{0} is required but is not in your spreadsheet. ".format(field_object.verbose_name.title())]
+            if field_name in model_info.required:
+                field_columns = matched_columns.get(field_name)
+                if field_columns:
+                    if field_columns.isdisjoint(header_columns):
+                        errors += [MatchError(
+                            'not_in_spreadsheet',
+                            u"{0} is required but is not in your spreadsheet. ".format(
+                                field_object.verbose_name.title()),
+                            field_name)]
                 else:
-                    errors += [u"{0} is required but has no match.".format(field_object.verbose_name.title())]
+                    errors += [MatchError(
+                        'no_match',
+                        u"{0} is required but has no match.".format(field_object.verbose_name.title()),
+                        field_name)]
     return errors
 
 
@@ -76,14 +101,18 @@ def match_columns(request, import_log_id):
     if not request.user.is_superuser and import_log.user != request.user:
         raise SuspiciousOperation("Non superuser attempting to view other users import")
 
+    # Only the header and one sample row are needed here
+    with closing(import_log.iter_import_rows()) as rows:
+        import_data = list(islice(rows, 2))
+
     # need to generate matches if they don't exist already
-    existing_matches = import_log.get_matches()
+    existing_matches = import_log.get_matches(
+        header_row=import_data[0] if import_data else None)
 
     MatchFormSet = inlineformset_factory(ImportSetting, ColumnMatch, form=MatchForm, extra=0)
 
-    import_data = import_log.get_import_file_as_list()
-    header_row = [x.lower() for x in import_data[0]] # make all lower
     try:
+        header_row = [x.lower() for x in import_data[0]] # make all lower
         sample_row = import_data[1]
     except IndexError:
         messages.error(request, 'Error: Spreadsheet was empty.')
@@ -92,12 +121,11 @@ def match_columns(request, import_log_id):
     errors = []
 
     model_class = import_log.import_setting.content_type.model_class()
-    field_names = get_all_field_names(model_class)
-    for field_name in field_names:
-        field_object = model_class._meta.get_field(field_name)
+    model_info = get_model_info(model_class)
+    field_names = [
+        field_name for field_name, field_object in model_info.fields.items()
         # We can't add a new AutoField and specify it's value
-        if import_log.import_type == "N" and isinstance(field_object, AutoField):
-            field_names.remove(field_name)
+        if not (import_log.import_type == "N" and isinstance(field_object, AutoField))]
 
     if request.method == 'POST':
         formset = MatchFormSet(request.POST, instance=import_log.import_setting)
@@ -141,7 +169,7 @@ def match_columns(request, import_log_id):
 
     field_choices = (('', 'Do Not Use'),)
     for field_name in field_names:
-        field_object = model_class._meta.get_field(field_name)
+        field_object = model_info.fields[field_name]
         direct = field_object.concrete
         m2m = field_object.many_to_many
         add = True
@@ -151,7 +179,7 @@ def match_columns(request, import_log_id):
         else:
             field_verbose = field_name
 
-        if direct and not field_object.blank:
+        if direct and field_name in model_info.required:
             field_verbose += " (Required)"
         if direct and field_object.unique:
             field_verbose += " (Unique)"
@@ -188,21 +216,14 @@ def match_columns(request, import_log_id):
 
 
 def get_direct_fields_from_model(model_class):
-    direct_fields = []
-    all_field_names = get_all_field_names(model_class)
-    for field_name in all_field_names:
-        field = model_class._meta.get_field(field_name)
-        direct = field.concrete
-        m2m = field.many_to_many
-        if direct and not m2m and field.__class__.__name__ != "ForeignKey":
-            direct_fields += [field]
-    return direct_fields
+    return list(get_model_info(model_class).direct_fields)
 
 
 @staff_member_required
 def match_relations(request, import_log_id):
     import_log = get_object_or_404(ImportLog, id=import_log_id)
     model_class = import_log.import_setting.content_type.model_class()
+    model_info = get_model_info(model_class)
     matches = import_log.get_matches()
     field_names = []
     choice_set = []
@@ -210,28 +231,19 @@ def match_relations(request, import_log_id):
     for match in matches.exclude(field_name=""):
         field_name = match.field_name
 
-        if not field_name.startswith('simple_import_method__'):
-            field = model_class._meta.get_field(field_name)
-            m2m = field.many_to_many
-
-            if m2m or isinstance(field, ForeignKey):
-                RelationalMatch.objects.get_or_create(
-                    import_log=import_log,
-                    field_name=field_name)
-
-                field_names.append(field_name)
-                choices = ()
-                if hasattr(field, 'related'):
-                    try:
-                        parent_model = field.related.parent_model()
-                    except AttributeError:  # Django 1.8+
-                        parent_model = field.related.model
-                else:
-                    parent_model = field.related_model
-                for field in get_direct_fields_from_model(parent_model):
-                    if field.unique:
-                        choices += ((field.name, str(field.verbose_name)),)
-                choice_set += [choices]
+        if field_name in model_info.related_models:
+            RelationalMatch.objects.get_or_create(
+                import_log=import_log,
+                field_name=field_name)
+
+            field_names.append(field_name)
+            choices = ()
+            parent_model = model_info.related_models[field_name]
+            parent_info = get_model_info(parent_model)
+            for field in parent_info.direct_fields:
+                if field.name in parent_info.unique:
+                    choices += ((field.name, str(field.verbose_name)),)
+            choice_set += [choices]
 
     existing_matches = import_log.relationalmatch_set.filter(field_name__in=field_names)
 
@@ -268,63 +280,14 @@ def match_relations(request, import_log_id):
     )
 
 
-def set_field_from_cell(import_log, new_object, header_row_field_name, cell):
-    """ Set a field from a import cell. Use referenced fields the field
-    is m2m or a foreign key.
-    """
-    if not header_row_field_name.startswith('simple_import_method__'):
-        field = new_object._meta.get_field(header_row_field_name)
-        m2m = field.many_to_many
-        if m2m:
-            new_object.simple_import_m2ms[header_row_field_name] = cell
-        elif isinstance(field, ForeignKey):
-            related_field_name = RelationalMatch.objects.get(
-                import_log=import_log,
-                field_name=field.name,
-            ).related_field_name
-            try:
-                related_model = field.remote_field.parent_model()
-            except AttributeError:
-                related_model = field.remote_field.model
-            related_object = related_model.objects.get(**{related_field_name:cell})
-            setattr(new_object, header_row_field_name, related_object)
-        elif field.choices and getattr(settings, 'SIMPLE_IMPORT_LAZY_CHOICES', True):
-            # Trim leading and trailing whitespace from cell values
-            if getattr(settings, 'SIMPLE_IMPORT_LAZY_CHOICES_STRIP', False):
-                cell = cell.strip()
-            # Prefer database values over choices lookup
-            database_values, verbose_values = zip(*field.choices)
-            if cell in database_values:
-                setattr(new_object, header_row_field_name, cell)
-            elif cell in verbose_values:
-                for choice in field.choices:
-                    if smart_text(cell) == smart_text(choice[1]):
-                        setattr(new_object, header_row_field_name, choice[0])
-        elif isinstance(field, BooleanField):
-            # Some formats/libraries report booleans as strings
-            if cell == False or cell == "FALSE":
-                setattr(new_object, header_row_field_name, False)
-            else:
-                setattr(new_object, header_row_field_name, cell)
-        else:
-            setattr(new_object, header_row_field_name, cell)
-
-
-def set_method_from_cell(import_log, new_object, header_row_field_name, cell):
-    """ Run a method from a import cell.
-    """
-    if not header_row_field_name.startswith('simple_import_method__'):
-        pass
-    elif header_row_field_name.startswith('simple_import_method__'):
-        getattr(new_object, header_row_field_name[22:])(cell)
-
-
 @staff_member_required
 def do_import(request, import_log_id):
     """ Import the data! """
     import_log = get_object_or_404(ImportLog, id=import_log_id)
-    if import_log.import_type == "N" and 'undo' in request.GET and request.GET['undo'] == "True":
-        import_log.undo()
+    import_log.fail_if_stale()
+    if (import_log.import_type == "N" and 'undo' in request.GET and request.GET['undo'] == "True" and
+            not import_log.is_running):
+        enqueue_undo(import_log)
         return HttpResponseRedirect(reverse(
                     do_import,
                     kwargs={'import_log_id': import_log.id}) + '?success_undo=True')
@@ -334,153 +297,58 @@ def do_import(request, import_log_id):
     else:
         success_undo = False
 
-    model_class = import_log.import_setting.content_type.model_class()
-    import_data = import_log.get_import_file_as_list()
-    header_row = import_data.pop(0)
-    header_row_field_names = []
-    header_row_default = []
-    header_row_null_on_empty = []
-    error_data = [header_row + ['Error Type', 'Error Details']]
-    create_count = 0
-    update_count = 0
-    fail_count = 0
     if 'commit' in request.GET and request.GET['commit'] == "True":
         commit = True
     else:
         commit = False
 
-    key_column_name = None
-    if import_log.update_key and import_log.import_type in ["U", "O"]:
-        key_match = import_log.import_setting.columnmatch_set.get(column_name=import_log.update_key)
-        key_column_name = key_match.column_name
-        key_field_name = key_match.field_name
-    for i, cell in enumerate(header_row):
-        match = import_log.import_setting.columnmatch_set.get(column_name=cell)
-        header_row_field_names += [match.field_name]
-        header_row_default += [match.default_value]
-        header_row_null_on_empty += [match.null_on_empty]
-        if key_column_name != None and key_column_name.lower() == cell.lower():
-            key_index = i
-
-    with transaction.atomic():
-        sid = transaction.savepoint()
-        for row in import_data:
-            try:
-                with transaction.atomic():
-                    is_created = True
-                    if import_log.import_type == "N":
-                        new_object = model_class()
-                    elif import_log.import_type == "O":
-                        filters = {key_field_name: row[key_index]}
-                        new_object = model_class.objects.get(**filters)
-                        is_created = False
-                    elif import_log.import_type == "U":
-                        filters = {key_field_name: row[key_index]}
-                        new_object = model_class.objects.filter(**filters).first()
-                        if new_object == None:
-                            new_object = model_class()
-                            is_created = False
-
-                    new_object.simple_import_m2ms = {} # Need to deal with these after saving
-                    for i, cell in enumerate(row):
-                        if header_row_field_names[i]: # skip blank
-                            if not import_log.is_empty(cell) or header_row_null_on_empty[i]:
-                                set_field_from_cell(import_log, new_object, header_row_field_names[i], cell)
-                            elif header_row_default[i]:
-                                set_field_from_cell(import_log, new_object, header_row_field_names[i], header_row_default[i])
-                    new_object.save()
-
-                    for i, cell in enumerate(row):
-                        if header_row_field_names[i]: # skip blank
-                            if not import_log.is_empty(cell) or header_row_null_on_empty[i]:
-                                set_method_from_cell(import_log, new_object, header_row_field_names[i], cell)
-                            elif header_row_default[i]:
-                                set_method_from_cell(import_log, new_object, header_row_field_names[i], header_row_default[i])
-                    new_object.save()
-
-                    for key in new_object.simple_import_m2ms.keys():
-                        value = new_object.simple_import_m2ms[key]
-                        m2m = getattr(new_object, key)
-                        m2m_model = type(m2m.model())
-                        related_field_name = RelationalMatch.objects.get(import_log=import_log, field_name=key).related_field_name
-                        m2m_object = m2m_model.objects.get(**{related_field_name:value})
-                        m2m.add(m2m_object)
-
-                    if is_created:
-                        LogEntry.objects.log_action(
-                            user_id         = request.user.pk,
-                            content_type_id = ContentType.objects.get_for_model(new_object).pk,
-                            object_id       = new_object.pk,
-                            object_repr     = smart_text(new_object),
-                            action_flag     = ADDITION
-                        )
-                        create_count += 1
-                    else:
-                        LogEntry.objects.log_action(
-                            user_id         = request.user.pk,
-                            content_type_id = ContentType.objects.get_for_model(new_object).pk,
-                            object_id       = new_object.pk,
-                            object_repr     = smart_text(new_object),
-                            action_flag     = CHANGE
-                        )
-                        update_count += 1
-                    ImportedObject.objects.create(
-                        import_log = import_log,
-                        object_id = new_object.pk,
-                        content_type = import_log.import_setting.content_type)
-            except IntegrityError:
-                exc = sys.exc_info()
-                error_data += [row + ["Integrity Error", smart_text(exc[1])]]
-                fail_count += 1
-            except ObjectDoesNotExist:
-                exc = sys.exc_info()
-                error_data += [row + ["No Record Found to Update", smart_text(exc[1])]]
-                fail_count += 1
-            except ValueError:
-                exc = sys.exc_info()
-                if str(exc[1]).startswith('invalid literal for int() with base 10'):
-                    error_data += [row + ["Incompatible Data - A number was expected, but a character was used", smart_text(exc[1])]]
-                else:
-                    error_data += [row + ["Value Error", smart_text(exc[1])]]
-                fail_count += 1
-            except:
-                error_data += [row + ["Unknown Error"]]
-                fail_count += 1
-        if not commit:
-            transaction.savepoint_rollback(sid)
-
-    if fail_count:
-        from io import StringIO
-        from django.core.files.base import ContentFile
-        from openpyxl.workbook import Workbook
-        from openpyxl.writer.excel import save_virtual_workbook
-
-        wb = Workbook()
-        ws = wb.worksheets[0]
-        ws.title = "Errors"
-        filename = 'Errors.xlsx'
-        for row in error_data:
-            ws.append(row)
-        buf = StringIO()
-        # Not Python 3 compatible
-        #buf.write(str(save_virtual_workbook(wb)))
-        import_log.error_file.save(filename, ContentFile(save_virtual_workbook(wb)))
-        import_log.save()
+    # Opening the page runs the import, unless we're only showing the
+    # results of the last run or an import is already in progress.
+    if not import_log.is_running and request.GET.get('results') != "True":
+        resume = commit and request.GET.get('resume') == "True"
+        enqueue_import(import_log, request.user, commit=commit, resume=resume)
+        import_log.refresh_from_db()
+
+    error_preview = []
+    if import_log.fail_count and not import_log.is_running:
+        error_preview = import_log.get_error_preview(
+            getattr(settings, 'SIMPLE_IMPORT_ERROR_PREVIEW_SIZE', 100))
 
     return render(
         request,
         'simple_import/do_import.html',
         {
-            'error_data': error_data,
-            'create_count': create_count,
-            'update_count': update_count,
-            'fail_count': fail_count,
+            'error_header': error_preview[:1],
+            'error_rows': error_preview[1:],
+            'create_count': import_log.create_count,
+            'update_count': import_log.update_count,
+            'fail_count': import_log.fail_count,
             'import_log': import_log,
-            'commit': commit,
+            'commit': import_log.commit,
             'success_undo': success_undo,},
     )
 
 
+@staff_member_required
+def import_status(request, import_log_id):
+    """ Progress of the import job as JSON, polled by do_import.html """
+    import_log = get_object_or_404(ImportLog, id=import_log_id)
+
+    if not request.user.is_superuser and import_log.user != request.user:
+        raise SuspiciousOperation("Non superuser attempting to view other users import")
+
+    import_log.fail_if_stale()
+    return JsonResponse({
+        'status': import_log.status,
+        'commit': import_log.commit,
+        'rows_done': import_log.rows_done,
+        'create_count': import_log.create_count,
+        'update_count': import_log.update_count,
+        'fail_count': import_log.fail_count,
+        'rows_per_second': import_log.rows_per_second,
+    })
+
+
 @staff_member_required
 def start_import(request):
     """ View to create a new import record
@@ -490,6 +358,8 @@ def start_import(request):
         if form.is_valid():
             import_log = form.save(commit=False)
             import_log.user = request.user
+            # Hashed while the upload is still local, it keys the parsed rows cache
+            import_log.file_hash = cache.get_file_hash(import_log.import_file)
             import_log.import_setting, created = ImportSetting.objects.get_or_create(
                 user=request.user,
                 content_type=form.cleaned_data['model'],